@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+import copy
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                                os.pardir, os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'condense', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import yaml
+
+from condense import settings
+from condense import util
+
+CONF_TPL = """
+# fragment %(i)s
+fragment_%(i)s:
+  enabled: true
+  name: "fragment number %(i)s"
+  retries: %(i)s
+  packages: [ "pkg-a-%(i)s", "pkg-b-%(i)s", "pkg-c-%(i)s" ]
+  mounts:
+   - [ ephemeral%(i)s, /media/ephemeral%(i)s, auto, "defaults" ]
+   - [ swap, none, swap, sw, "0", "0" ]
+  settings:
+    timeout: 5
+    max_wait: 60
+    backoff: { base: 1, factor: 2, cap: 10 }
+"""
+
+
+def timed(func, repeat):
+    best = None
+    for _i in range(0, repeat):
+        start = time.time()
+        func()
+        took = time.time() - start
+        if best is None or took < best:
+            best = took
+    return best
+
+
+def report(name, took, baseline=None):
+    line = "  %-40s %10.3f ms" % (name, took * 1000)
+    if baseline:
+        line += "  (%.1fx)" % (baseline / took)
+    print(line)
+
+
+def bench_read_conf(opts):
+    work_dir = tempfile.mkdtemp()
+    orig_cache_dir = settings.parse_cache_dir
+    orig_loader = util.get_yaml_loader()
+    try:
+        confd = os.path.join(work_dir, 'condense.cfg.d')
+        os.makedirs(confd)
+        for i in range(0, opts['fragments']):
+            with open(os.path.join(confd, "%03d.cfg" % (i)), "w") as fh:
+                fh.write(CONF_TPL % {'i': i})
+        settings.parse_cache_dir = os.path.join(work_dir, 'parse-cache')
+
+        def cold():
+            shutil.rmtree(settings.parse_cache_dir, ignore_errors=True)
+            util.read_conf_d(confd)
+
+        def warm():
+            util.read_conf_d(confd)
+
+        print("read_conf_d of %s fragments (best of %s):" %
+              (opts['fragments'], opts['repeat']))
+        util.YamlLoader = yaml.Loader
+        baseline = timed(cold, opts['repeat'])
+        report("cold, pure python loader", baseline)
+        if orig_loader is not yaml.Loader:
+            util.YamlLoader = orig_loader
+            report("cold, libyaml loader", timed(cold, opts['repeat']),
+                   baseline)
+        else:
+            print("  (libyaml is not available)")
+        util.YamlLoader = orig_loader
+        warm()
+        report("warm, parse cache", timed(warm, opts['repeat']), baseline)
+    finally:
+        util.YamlLoader = orig_loader
+        settings.parse_cache_dir = orig_cache_dir
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def legacy_mergedict(src, cand):
+    # the recursive (and src modifying) merge util.mergedict used to be
+    if isinstance(src, dict) and isinstance(cand, dict):
+        for k, v in cand.iteritems():
+            if k not in src:
+                src[k] = v
+            else:
+                src[k] = legacy_mergedict(src[k], v)
+    return src
+
+
+def make_cloud_config(seed, width, depth):
+    # a (large) nested cloud-config, where configs made with different
+    # seeds share about half of their keys
+    cfg = {}
+    for i in range(0, width):
+        key = "key_%s" % ((i + seed * (width // 2)) % (width * 2))
+        if depth > 1:
+            cfg[key] = make_cloud_config(seed, width, depth - 1)
+        else:
+            cfg[key] = ["value", seed, i]
+    return cfg
+
+
+def bench_mergedict(opts):
+    sources = [make_cloud_config(seed, opts['width'], opts['depth'])
+               for seed in range(0, opts['sources'])]
+
+    def legacy():
+        # the sources have to be copied, the merge modifies them
+        merged = copy.deepcopy(sources[0])
+        for cand in sources[1:]:
+            merged = legacy_mergedict(merged, copy.deepcopy(cand))
+
+    # copies made up front, so that only the merge itself is timed
+    copies = [copy.deepcopy(sources) for _i in range(0, opts['repeat'])]
+
+    def legacy_merge_only():
+        srcs = copies.pop()
+        merged = srcs[0]
+        for cand in srcs[1:]:
+            merged = legacy_mergedict(merged, cand)
+
+    def merge_dicts():
+        util.merge_dicts(*sources)
+
+    print("mergedict of %s cloud-configs %s wide and %s deep (best of %s):" %
+          (opts['sources'], opts['width'], opts['depth'], opts['repeat']))
+    baseline = timed(legacy, opts['repeat'])
+    report("recursive, copying sources", baseline)
+    report("recursive, merge only (not copying)",
+           timed(legacy_merge_only, opts['repeat']), baseline)
+    report("merge_dicts", timed(merge_dicts, opts['repeat']), baseline)
+
+    deep = [{}, {}]
+    for d in deep:
+        cur = d
+        for _i in range(0, sys.getrecursionlimit() * 2):
+            cur['nested'] = {}
+            cur = cur['nested']
+        cur[str(id(d))] = True
+    try:
+        legacy_mergedict(copy.copy(deep[0]), deep[1])
+        print("  recursive merge of %s deep configs worked" %
+              (sys.getrecursionlimit() * 2))
+    except RuntimeError:
+        print("  recursive merge of %s deep configs hit the recursion limit"
+              % (sys.getrecursionlimit() * 2))
+    util.merge_dicts(*deep)
+    print("  merge_dicts of %s deep configs worked" %
+          (sys.getrecursionlimit() * 2))
+
+
+# Imports bin/condenser (without running it) and then the modules the given
+# action would import to run its stage, printing (as json) how long each took,
+# the peak rss and which of the heavier dependencies got imported
+STARTUP_CHILD = """
+import imp, json, resource, sys, time
+(condenser, config, work_dir, action, stage) = sys.argv[1:]
+started = time.time()
+imp.load_source('condenser', condenser)
+imported = time.time()
+from condense import data_source, importer, registry, settings, util
+settings.registry_index = work_dir + '/registry.marshal'
+settings.parse_cache_dir = work_dir + '/parse-cache'
+cfg = util.read_conf(config) or {}
+if action == 'start':
+    data_source.list_sources(cfg.get('datasource_list', []),
+                             [data_source.DEP_FILESYSTEM])
+    data_source.list_sources(cfg.get('datasource_list', []),
+                             [data_source.DEP_FILESYSTEM,
+                              data_source.DEP_NETWORK])
+for item in cfg.get(settings.stage_tpl % (stage), []):
+    name = item if isinstance(item, str) else item[0]
+    importer.import_module(registry.get_registry().get_handler(name)['module'])
+finished = time.time()
+print(json.dumps({
+    'import': imported - started,
+    'stage': finished - imported,
+    'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'heavy': sorted(m for m in ['Cheetah', 'email', 'prettytable', 'yaml']
+                    if sys.modules.get(m)),
+}))
+"""
+
+# The stage each action runs
+STARTUP_STAGES = {
+    'start': 'init',
+    'config': 'config',
+    'final': 'final',
+}
+
+
+def bench_startup(opts):
+    work_dir = tempfile.mkdtemp()
+    condenser = os.path.join(possible_topdir, 'bin', 'condenser')
+    try:
+        print("condenser startup per action (best of %s):" % (opts['repeat']))
+        for action in ['start', 'config', 'final']:
+            cmd = [sys.executable, "-c", STARTUP_CHILD, condenser,
+                   opts['config'], work_dir, action, STARTUP_STAGES[action]]
+            runs = []
+            # (the first run builds the registry & parse caches)
+            for _i in range(0, opts['repeat'] + 1):
+                sp = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+                (out, err) = sp.communicate()
+                if sp.returncode != 0:
+                    print("  %-8s failed:\n%s" % (action, err))
+                    break
+                runs.append(json.loads(out))
+            if len(runs) <= 1:
+                continue
+            runs = runs[1:]
+            print("  %-8s import %8.3f ms, stage modules %8.3f ms, "
+                  "peak rss %6s KB" %
+                  (action, min(r['import'] for r in runs) * 1000,
+                   min(r['stage'] for r in runs) * 1000,
+                   min(r['rss'] for r in runs)))
+            print("  %-8s heavy modules imported: %s" %
+                  ("", ", ".join(runs[-1]['heavy']) or "none"))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+BENCHMARKS = {
+    'mergedict': bench_mergedict,
+    'read_conf': bench_read_conf,
+    'startup': bench_startup,
+}
+
+
+def extract_opts():
+    parser = OptionParser(usage="%%prog [options] [%s]..." %
+                          ("|".join(sorted(BENCHMARKS.keys()))))
+    parser.add_option("-r", "--repeat", dest="repeat", action="store",
+                  type=int, default=5,
+                  help="times to run each case, the best is reported (default: %default)")
+    parser.add_option("-f", "--fragments", dest="fragments", action="store",
+                  type=int, default=50,
+                  help="config fragments to read (default: %default)")
+    parser.add_option("--sources", dest="sources", action="store",
+                  type=int, default=4,
+                  help="cloud-configs to merge (default: %default)")
+    parser.add_option("--width", dest="width", action="store",
+                  type=int, default=10,
+                  help="keys at each level of the cloud-configs to merge (default: %default)")
+    parser.add_option("--depth", dest="depth", action="store",
+                  type=int, default=4,
+                  help="levels of the cloud-configs to merge (default: %default)")
+    parser.add_option("-c", "--config", dest="config", action="store",
+                  default=os.path.join(possible_topdir, 'config',
+                                       'condense.cfg'),
+                  help="config to read the stages from (default: %default)",
+                  metavar="FILE")
+    (options, args) = parser.parse_args()
+    out = dict()
+    out['repeat'] = max(1, options.repeat)
+    out['fragments'] = max(1, options.fragments)
+    out['sources'] = max(1, options.sources)
+    out['width'] = max(1, options.width)
+    out['depth'] = max(1, options.depth)
+    out['config'] = options.config
+    out['benchmarks'] = args or sorted(BENCHMARKS.keys())
+    return out
+
+
+def main():
+    opts = extract_opts()
+    for name in opts['benchmarks']:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark %r, pick from %s" %
+                  (name, ", ".join(sorted(BENCHMARKS.keys()))))
+            return 1
+    for name in opts['benchmarks']:
+        BENCHMARKS[name](opts)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
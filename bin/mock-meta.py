@@ -2,6 +2,7 @@
 
 import functools
 import httplib
+import json
 import logging
 import sys
 import string
@@ -11,6 +12,7 @@ import yaml
 from optparse import OptionParser
 
 from BaseHTTPServer import (HTTPServer, BaseHTTPRequestHandler)
+from SocketServer import ThreadingMixIn
 
 log = logging.getLogger('meta-server')
 
@@ -28,6 +30,16 @@ EC2_VERSIONS = [
     'latest',
 ]
 
+OS_VERSIONS = [
+    '2012-08-10',
+    'latest',
+]
+
+OS_FILES = [
+    'meta_data.json',
+    'user_data',
+]
+
 BLOCK_DEVS = [
     'ami',
     'root',
@@ -111,7 +123,7 @@ class MetaDataHandler(object):
         action = params[0]
         action = action.lower()
         if action == 'instance-id':
-            return 'i-%s' % (id_generator(lower=True))
+            return self.opts['instance_id']
         elif action == 'ami-launch-index':
             return "%s" % INSTANCE_INDEX
         elif action == 'aki-id':
@@ -145,6 +157,19 @@ class MetaDataHandler(object):
         else:
             return ''
 
+    def get_openstack_data(self, who):
+        data = {
+            'uuid': self.opts['uuid'],
+            'name': who,
+            'hostname': who,
+            'availability_zone': PLACEMENT_CAPABILITIES['availability-zone'],
+            'launch_index': INSTANCE_INDEX,
+            'public_keys': {},
+            'meta': {},
+        }
+        return json.dumps(data)
+
+
 class UserDataHandler(object):
 
     def __init__(self, opts):
@@ -172,8 +197,17 @@ meta_fetcher = None
 user_fetcher = None
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
 class Ec2Handler(BaseHTTPRequestHandler):
 
+    # Allow keep-alive connections (like the real metadata services)
+    # and send each response out in one go instead of line by line.
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
     def _get_versions(self):
         return "\n".join(EC2_VERSIONS)
 
@@ -181,6 +215,31 @@ class Ec2Handler(BaseHTTPRequestHandler):
         msg = "%s - %s" % (self.address_string(), format % (args))
         log.info(msg)
 
+    def _get_os_versions(self):
+        return "\n".join(OS_VERSIONS)
+
+    def _get_os_files(self):
+        return "\n".join(OS_FILES)
+
+    def _find_os_method(self, segments):
+        # Puke! (globals)
+        global meta_fetcher
+        global user_fetcher
+        if not segments:
+            return self._get_os_versions
+        date = segments[0].strip().lower()
+        if date not in OS_VERSIONS:
+            raise IOError("Unknown openstack version %r" % date)
+        if len(segments) == 1:
+            return self._get_os_files
+        who = self.address_string()
+        look_name = segments[1].lower()
+        if look_name == 'meta_data.json':
+            return functools.partial(meta_fetcher.get_openstack_data, who=who)
+        if look_name == 'user_data':
+            return functools.partial(user_fetcher.get_data, params=[], who=who)
+        raise IOError("Unknown openstack data %r" % look_name)
+
     def _find_method(self, path):
         # Puke! (globals)
         global meta_fetcher
@@ -192,6 +251,10 @@ class Ec2Handler(BaseHTTPRequestHandler):
         segments = [piece for piece in path.split('/') if len(piece)]
         if not segments:
             return self._get_versions
+        if segments[0] == 'openstack':
+            if not self.server.opts['openstack']:
+                raise IOError("Openstack metadata is not being served")
+            return self._find_os_method(segments[1:])
         date = segments[0].strip().lower()
         if date not in EC2_VERSIONS:
             raise RuntimeError("Unknown date format %r" % date)
@@ -243,10 +306,19 @@ def extract_opts():
     parser = OptionParser()
     parser.add_option("-p", "--port", dest="port", action="store", type=int, default=80,
                   help="port from which to serve traffic (default: %default)", metavar="PORT")
+    parser.add_option("--no-openstack", dest="openstack", action="store_false", default=True,
+                  help="do not serve the openstack (json) metadata")
+    parser.add_option("--instance-id", dest="instance_id", action="store",
+                  help="instance-id to serve (default: a random one)", metavar="ID")
+    parser.add_option("--uuid", dest="uuid", action="store",
+                  help="openstack uuid to serve (default: a random one)", metavar="UUID")
     (options, args) = parser.parse_args()
     out = dict()
     out['extra'] = args
     out['port'] = options.port
+    out['openstack'] = options.openstack
+    out['instance_id'] = options.instance_id or 'i-%s' % (id_generator(lower=True))
+    out['uuid'] = options.uuid or id_generator(size=32, lower=True)
     return out
 
 
@@ -264,7 +336,8 @@ def run_server():
     setup_logging(logging.DEBUG)
     setup_fetchers(opts)
     log.info("CLI opts: %s", opts)
-    server = HTTPServer(('0.0.0.0', opts['port']), Ec2Handler)
+    server = ThreadingHTTPServer(('0.0.0.0', opts['port']), Ec2Handler)
+    server.opts = opts
     sa = server.socket.getsockname()
     log.info("Serving server on %s using port %s ...", sa[0], sa[1])
     server.serve_forever()
@@ -48,7 +48,18 @@ function run_pylint {
   echo "Check '$output_filename' for a full report."
 }
 
+function run_tests {
+  echo "Running tests ..."
+  output_filename="tests.log"
+  python -m unittest discover tests > $output_filename 2>&1
+  if [ "$?" -ne "0" ]; then
+    echo "Some tests failed!"
+  fi
+  echo "Check '$output_filename' for a full report."
+}
+
 
 run_pep8
 run_pylint
+run_tests
 
@@ -22,9 +22,11 @@
 
 import errno
 import glob
+import hashlib
 import os
 import subprocess
 import sys
+import threading
 import traceback
 
 from time import time
@@ -32,24 +34,27 @@ from time import time
 import cPickle
 import StringIO
 
-import yaml
-
+from condense import cache
+from condense import cfg_cache
 from condense import data_source
 from condense import exceptions as excp
 from condense import log as logging
 from condense import util
 from condense import importer
+from condense import registry
+from condense import semaphores
 from condense import user_data as ud
 
 from condense.settings import (system_config, cfg_builtin, cur_instance_link,
                                per_always, varlibdir, pathmap, per_instance,
-                               boot_finished, per_once, cc_mod_tpl)
+                               boot_finished, per_once)
 
 log = logging.getLogger()
 parsed_cfgs = {}
 
 
 class Init:
+    _sem_db_lock = threading.Lock()
 
     def __init__(self, ds_deps=None, sysconfig=system_config):
         if ds_deps != None:
@@ -63,6 +68,7 @@ class Init:
             ['text/cloud-config', self.handle_cloud_config, per_always],
         ]
         self.datasource = None
+        self._sem_db = None
         self.cloud_config_str = ''
         self.datasource_name = ''
 
@@ -79,7 +85,26 @@ class Init:
 
         self.cloud_config_str += "\n#%s\n%s" % (filename, payload)
 
-    def consume_userdata(self, frequency=per_instance):
+    def userdata_consumed(self, digest):
+        # was this very userdata consumed before (and is what that
+        # produced still around)
+        try:
+            with open(self.get_ipath('userdata_hash'), "rb") as fh:
+                last_digest = fh.read().strip()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                util.logexc(log)
+            return False
+        if last_digest != digest:
+            return False
+        return os.path.exists(self.get_ipath('cloud_config'))
+
+    def consume_userdata(self, frequency=per_instance, force=False):
+        digest = hashlib.sha1(self.get_userdata_raw() or '').hexdigest()
+        if not force and self.userdata_consumed(digest):
+            log.info("Userdata (sha1 %s) is unchanged, reusing what "
+                     "consuming it produced last time", digest)
+            return False
 
         part_handlers = {}
         for (btype, bhand, bfreq) in self.builtin_handlers:
@@ -102,40 +127,121 @@ class Init:
                 handler_call_end(mod, frequency)
                 called.append(mod)
 
+        util.write_file(self.get_ipath('userdata_hash'), "%s\n" % (digest),
+                        0600)
+        return True
+
     def read_cfg(self):
         if self.cfg:
             return self.cfg
-        try:
-            conf = util.get_base_cfg(self.sysconfig, cfg_builtin, parsed_cfgs)
-        except Exception:
-            conf = get_builtin_cfg()
+        if self.sysconfig in parsed_cfgs:
+            return parsed_cfgs[self.sysconfig]
+
+        # what an earlier stage parsed (if none of it changed since)
+        compiled_fn = get_cpath('base_config_compiled')
+        key = [self.sysconfig, cfg_builtin]
+        conf = cfg_cache.load(compiled_fn, key)
+        if conf is None:
+            inputs = []
+            try:
+                conf = util.get_base_cfg(self.sysconfig, cfg_builtin,
+                                         inputs=inputs)
+            except Exception:
+                return get_builtin_cfg()
+            cfg_cache.save(compiled_fn, conf, inputs, key)
+        parsed_cfgs[self.sysconfig] = conf
         return conf
 
     def restore_from_cache(self):
+        # we try to restore from a current link and static path
+        # by using the instance link, if purge_cache was called
+        # the file wont exist
+        fn = get_ipath_cur('obj_cache')
+        try:
+            self.datasource = cache.load_datasource(fn, self.cfg)
+            return True
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                util.logexc(log)
+        except Exception:
+            log.warn("Unable to restore from cache: %s", fn)
+            util.logexc(log)
+
+        # the cache of an older version (if it is still around)
         try:
-            # we try to restore from a current link and static path
-            # by using the instance link, if purge_cache was called
-            # the file wont exist
-            cache = get_ipath_cur('obj_pkl')
-            with open(cache, "rb") as f:
+            fn = get_ipath_cur('obj_pkl')
+            with open(fn, "rb") as f:
                 data = cPickle.load(f)
             self.datasource = data
+            log.debug("Restored from the (older) pickled cache: %s", fn)
             return True
         except Exception:
             return False
 
+    def cache_is_current(self):
+        """
+        Check that the (restored) cached datasource still belongs to the
+        instance we are running on, by asking its source for the current
+        instance-id (with a short timeout) and comparing it to the cached
+        one. When the source can not tell, the cache is trusted.
+        """
+        if not util.get_cfg_option_bool(self.cfg, 'cache_revalidate', True):
+            return True
+        timeout = self.cfg.get('cache_revalidate_timeout', 2)
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            timeout = 2
+        cached_iid = self.get_instance_id()
+        start = time()
+        try:
+            cur_iid = self.datasource.get_current_instance_id(timeout)
+        except Exception:
+            util.logexc(log)
+            cur_iid = None
+        if cur_iid is None:
+            log.info("Unable to revalidate the cached instance-id %r, "
+                     "trusting the cache", cached_iid)
+            return True
+        if str(cur_iid) != str(cached_iid):
+            log.warn("Cached instance-id %r does not match the current "
+                     "instance-id %r", cached_iid, cur_iid)
+            return False
+        log.debug("Cached instance-id %r is still current (checked in %.3f "
+                  "seconds)", cached_iid, time() - start)
+        return True
+
     def write_to_cache(self):
-        cache = self.get_ipath("obj_pkl")
+        fn = self.get_ipath("obj_cache")
         try:
-            os.makedirs(os.path.dirname(cache))
+            os.makedirs(os.path.dirname(fn))
         except OSError as e:
             if e.errno != errno.EEXIST:
                 return False
 
-        with open(cache, "wb") as f:
-            cPickle.dump(self.datasource, f)
-            f.flush()
-            os.chmod(cache, 0400)
+        # the userdata is written beside the cache by store_userdata
+        files = {}
+        for name in ('userdata_raw', 'userdata'):
+            files[name] = os.path.basename(pathmap[name])
+        cache.save_datasource(fn, self.datasource, files)
+
+        # a pickled cache of an older version would only go stale now
+        try:
+            os.unlink(self.get_ipath("obj_pkl"))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return True
+
+    def flush_cache(self):
+        # lazily loaded metadata may have picked up more keys since the
+        # cache was written, keep those around for the next stage
+        metadata = getattr(self.datasource, 'metadata', None)
+        if not getattr(metadata, 'dirty', False):
+            return False
+        metadata.dirty = False
+        self.write_to_cache()
+        return True
 
     def get_data_source(self):
         if self.datasource is not None:
@@ -146,26 +252,118 @@ class Init:
             return True
 
         cfglist = self.cfg['datasource_list']
-        dslist = list_sources(cfglist, self.ds_deps)
+        dslist = []
+        for deps in dependency_stages(self.ds_deps):
+            for cls in list_sources(cfglist, deps):
+                if cls not in dslist:
+                    dslist.append(cls)
         dsnames = [f.__name__ for f in dslist]
-        log.debug("Searching for data source in %s" % dsnames)
-        for cls in dslist:
-            ds = cls.__name__
+        probe_mode = util.get_cfg_option_str(self.cfg, 'datasource_probe',
+                                             'serial')
+        log.debug("Searching (%s) for data source in %s" %
+                  (probe_mode, dsnames))
+        if probe_mode == 'concurrent':
+            timeout = self.cfg.get('datasource_probe_timeout')
             try:
-                s = cls(sys_cfg=self.cfg)
-                log.debug("Checking if %r can provide us the needed data.", ds)
-                if s.get_data():
-                    self.datasource = s
-                    self.datasource_name = ds
-                    return True
-            except Exception:
-                log.warn("Get data of %s raised!", ds)
-                util.logexc(log)
+                timeout = float(timeout)
+            except (TypeError, ValueError):
+                timeout = None
+            found = self._find_data_source_concurrent(dslist, timeout)
+        else:
+            if probe_mode != 'serial':
+                log.warn("Unknown datasource probe mode %r, probing "
+                         "serially", probe_mode)
+            found = self._find_data_source_serial(dslist)
+
+        if found:
+            (cls, s) = found
+            self.datasource = s
+            self.datasource_name = cls.__name__
+            return True
 
         msg = "Did not find data source. Searched classes: %s" % (dsnames)
         log.debug(msg)
         raise excp.DataSourceNotFoundException(msg)
 
+    def _probe_data_source(self, cls):
+        ds = cls.__name__
+        try:
+            s = cls(sys_cfg=self.cfg)
+            log.debug("Checking if %r can provide us the needed data.", ds)
+            if s.get_data():
+                return s
+        except Exception:
+            log.warn("Get data of %s raised!", ds)
+            util.logexc(log)
+        return None
+
+    def _find_data_source_serial(self, dslist):
+        for cls in dslist:
+            s = self._probe_data_source(cls)
+            if s:
+                return (cls, s)
+        return None
+
+    def _find_data_source_concurrent(self, dslist, timeout=None):
+        # start all of the sources at once, but still pick by priority, a
+        # source only wins once all of the ones before it gave up (or did
+        # not finish within the timeout)
+        cond = threading.Condition()
+        results = {}
+
+        def prober(i, cls):
+            s = self._probe_data_source(cls)
+            with cond:
+                results[i] = s
+                cond.notify_all()
+
+        for (i, cls) in enumerate(dslist):
+            t = threading.Thread(target=prober, args=(i, cls),
+                                 name="datasource-%s" % (cls.__name__))
+            t.daemon = True
+            t.start()
+
+        started = time()
+        winner = None
+        with cond:
+            while True:
+                waiting = False
+                timed_out = timeout and (time() - started) >= timeout
+                for i in range(0, len(dslist)):
+                    if i in results:
+                        if results[i] is not None:
+                            winner = i
+                            break
+                    elif not timed_out:
+                        waiting = True
+                        break
+                if winner is not None or not waiting:
+                    break
+                wait_for = None
+                if timeout:
+                    wait_for = max(0.1, (started + timeout) - time())
+                cond.wait(wait_for)
+
+            for (i, cls) in enumerate(dslist):
+                if winner is not None and i == winner:
+                    continue
+                if i not in results:
+                    if winner is not None and i > winner:
+                        log.info("Abandoned data source %s, a higher "
+                                 "priority source was found first",
+                                 cls.__name__)
+                    else:
+                        log.warn("Abandoned data source %s, it did not "
+                                 "finish within %s seconds", cls.__name__,
+                                 timeout)
+                elif results[i] is not None:
+                    log.info("Discarded data source %s, a higher priority "
+                             "source was found", cls.__name__)
+
+        if winner is None:
+            return None
+        return (dslist[winner], results[winner])
+
     def set_cur_instance(self):
         try:
             os.unlink(cur_instance_link)
@@ -199,8 +397,8 @@ class Init:
         return self.datasource.get_instance_id()
 
     def update_cache(self):
-        self.write_to_cache()
         self.store_userdata()
+        self.write_to_cache()
 
     def store_userdata(self):
         util.write_file(self.get_ipath('userdata_raw'),
@@ -208,55 +406,77 @@ class Init:
         util.write_file(self.get_ipath('userdata'),
             self.datasource.get_userdata(), 0600)
 
+    # where semaphores were kept (as a file each) before the semaphore db
     def sem_getpath(self, name, freq):
         if freq == 'once-per-instance':
             return("%s/%s" % (self.get_ipath("sem"), name))
         return("%s/%s.%s" % (get_cpath("sem"), name, freq))
 
+    def sem_key(self, name, freq):
+        if freq == per_instance:
+            return "%s/%s" % (self.get_instance_id(), name)
+        return "%s.%s" % (name, freq)
+
+    def sem_db(self):
+        # (handlers of a stage may run at once)
+        with self._sem_db_lock:
+            if self._sem_db is None:
+                self._sem_db = semaphores.SemaphoreDB(get_cpath("sem_db"),
+                                                      self._sem_legacy)
+        return self._sem_db
+
+    def _sem_legacy(self):
+        # key => (time, pid) of the semaphore files there are
+        found = {}
+        sem_dirs = [(get_cpath("sem"), "")]
+        if self.datasource is not None:
+            sem_dirs.append((self.get_ipath("sem"),
+                             "%s/" % (self.get_instance_id())))
+        for (sem_dir, prefix) in sem_dirs:
+            try:
+                names = os.listdir(sem_dir)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            for name in names:
+                try:
+                    with open(os.path.join(sem_dir, name), "r") as fh:
+                        contents = fh.read().splitlines()
+                    (when, pid) = (float(contents[0]), int(contents[1]))
+                except (IOError, IndexError, ValueError):
+                    (when, pid) = (None, None)
+                found[prefix + name] = (when, pid)
+        return found
+
     def sem_has_run(self, name, freq):
         if freq == per_always:
             return False
-        semfile = self.sem_getpath(name, freq)
-        if os.path.exists(semfile):
-            return True
-        return False
+        return self.sem_db().has(self.sem_key(name, freq))
 
     def sem_acquire(self, name, freq):
-        semfile = self.sem_getpath(name, freq)
-
-        try:
-            os.makedirs(os.path.dirname(semfile))
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise e
-
-        if os.path.exists(semfile) and freq != per_always:
-            return False
-
-        # TODO: race condition?? - probably should use real lock sometime
-        try:
-            with open(semfile, "w") as f:
-                contents = []
-                contents.append("%s" % str(time()))
-                contents.append("%s" % (os.getpid()))
-                contents.append("%s" % (os.getpid()))
-                f.write("\n".join(contents))
-            log.debug("Acquired file sempahore: %s", semfile)
-        except IOError:
+        if freq == per_always:
+            return True
+        key = self.sem_key(name, freq)
+        if not self.sem_db().acquire(key):
             return False
-
+        log.debug("Acquired semaphore: %s", key)
         return True
 
     def sem_clear(self, name, freq):
-        semfile = self.sem_getpath(name, freq)
-        try:
-            os.unlink(semfile)
-            log.debug("Clearing file sempahore: %s", semfile)
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                return False
+        if freq == per_always:
+            return True
+        key = self.sem_key(name, freq)
+        self.sem_db().clear(key)
+        log.debug("Cleared semaphore: %s", key)
         return True
 
+    def sem_flush(self):
+        # called at the end of each stage, the semaphores were written as
+        # they were acquired & cleared, this syncs (and compacts) them
+        if self._sem_db is not None:
+            self._sem_db.flush()
+
     # acquire lock on 'name' for given 'freq'
     # if that does not exist, then call 'func' with given 'args'
     # if 'clear_on_fail' is True and func throws an exception
@@ -315,6 +535,19 @@ class Config():
         self.cfg = self.get_config_obj(cfgfile)
 
     def get_config_obj(self, cfgfile):
+        try:
+            ds_cfg = self.cloud.datasource.get_config_obj()
+        except Exception:
+            ds_cfg = {}
+
+        # what an earlier stage merged (if none of it changed since)
+        compiled_fn = self.cloud.get_ipath('cloud_config_compiled')
+        key = [cfgfile, ds_cfg, self.cloud.cfg]
+        cfg = cfg_cache.load(compiled_fn, key)
+        if cfg is not None:
+            return cfg
+
+        parsed = True
         try:
             cfg = util.read_conf(cfgfile)
         except Exception:
@@ -322,31 +555,40 @@ class Config():
                          "Continuing with empty config" % cfgfile)
             util.logexc(log)
             cfg = None
+            parsed = False
 
         if cfg is None:
             cfg = {}
 
-        try:
-            ds_cfg = self.cloud.datasource.get_config_obj()
-        except Exception:
-            ds_cfg = {}
+        cfg = util.merge_dicts(cfg, ds_cfg, self.cloud.cfg)
+        if parsed:
+            cfg_cache.save(compiled_fn, cfg, [cfgfile], key)
+        return cfg
 
-        cfg = util.mergedict(cfg, ds_cfg)
-        return util.mergedict(cfg, self.cloud.cfg)
+    def get_handler_info(self, name):
+        """
+        Returns what the registry has on a handler (without importing it).
+        """
+        return registry.get_registry().get_handler(name)
 
-    def handle(self, name, args, freq=None):
-        real_name = name.replace("-", "_")
-        mod_name = cc_mod_tpl % (real_name)
+    def get_handler_module(self, name):
+        mod_name = self.get_handler_info(name)['module']
         log.debug("Importing handler module: %s", mod_name)
+        return importer.import_module(mod_name)
 
-        mod = importer.import_module(mod_name)
-        def_freq = getattr(mod, "frequency", per_instance)
-        handler = getattr(mod, "handle")
-
+    def handle(self, name, args, freq=None):
         if not freq:
-            freq = def_freq
+            freq = self.get_handler_info(name)['frequency']
 
-        self.cloud.sem_and_run("config-" + name, freq, handler,
+        semname = "config-" + name
+        if self.cloud.sem_has_run(semname, freq):
+            # (no need to import what is not going to run)
+            log.debug("%s already ran %s", semname, freq)
+            return False
+
+        mod = self.get_handler_module(name)
+        handler = getattr(mod, "handle")
+        return self.cloud.sem_and_run(semname, freq, handler,
             [name, self.cfg, self.cloud, log, args])
 
 
@@ -400,6 +642,18 @@ def list_sources(cfg_list, depends):
     return data_source.list_sources(cfg_list, depends)
 
 
+# the dependency sets to search (in order) when searching with 'depends'
+# so that sources that only need the filesystem (local seeds) are always
+# tried before the ones that need the network
+def dependency_stages(depends):
+    stages = []
+    if (data_source.DEP_FILESYSTEM in depends and
+        data_source.DEP_NETWORK in depends):
+        stages.append([data_source.DEP_FILESYSTEM])
+    stages.append(depends)
+    return stages
+
+
 def handler_register(mod, part_handlers,  frequency):
     for mtype in mod.list_types():
         if mtype not in part_handlers:
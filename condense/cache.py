@@ -0,0 +1,280 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+The instance cache, a single file laid out as:
+
+    condense-cache <version> <header length>\\n
+    <json header>
+    <section>...
+
+The header names the datasource class, the (offset, length, sha1) of each
+section and the names & sha1s of the files (the userdata) that are kept
+beside the cache. The file is memory mapped when read so that only the
+sections that are asked for are ever read in.
+"""
+
+import errno
+import hashlib
+import json
+import mmap
+import os
+import time
+
+import condense.data_source as data_source
+import condense.exceptions as excp
+import condense.importer as importer
+import condense.log as logging
+
+log = logging.getLogger()
+
+# Bump whenever the layout of the cache changes
+CACHE_VERSION = 1
+MAGIC = "condense-cache"
+
+
+def _hash(blob):
+    return hashlib.sha1(blob).hexdigest()
+
+
+def _to_str(obj):
+    # json gives back unicode, which is not what was cached (and which
+    # the yaml dumper would tag as !!python/unicode)
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_to_str(v) for v in obj]
+    if isinstance(obj, dict):
+        return dict((_to_str(k), _to_str(v)) for (k, v) in obj.items())
+    return obj
+
+
+def _loads(blob):
+    return _to_str(json.loads(blob))
+
+
+def _escape(key):
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(tok):
+    return tok.replace("~1", "/").replace("~0", "~")
+
+
+def flatten(tree, prefix=""):
+    """
+    Flatten nested dictionaries into a path => value index, where a path
+    is the '/' joined (escaped) keys leading to the value.
+    """
+    index = {}
+    for (key, value) in tree.items():
+        path = prefix + _escape(key)
+        if isinstance(value, dict) and value:
+            index.update(flatten(value, path + "/"))
+        else:
+            index[path] = value
+    return index
+
+
+def unflatten(index):
+    tree = {}
+    for (path, value) in index.items():
+        toks = [_unescape(tok) for tok in path.split("/")]
+        target = tree
+        for tok in toks[0:-1]:
+            target = target.setdefault(tok, {})
+        target[toks[-1]] = value
+    return tree
+
+
+def write(fn, header, sections):
+    """
+    Atomically write a cache file with the given header & (name => blob)
+    sections.
+    """
+    names = sorted(sections.keys())
+    index = {}
+    offset = 0
+    for name in names:
+        blob = sections[name]
+        index[name] = [offset, len(blob), _hash(blob)]
+        offset += len(blob)
+    header = dict(header)
+    header['version'] = CACHE_VERSION
+    header['sections'] = index
+    header_blob = json.dumps(header, sort_keys=True)
+
+    tmp_fn = "%s.tmp" % (fn)
+    try:
+        os.unlink(tmp_fn)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    with open(tmp_fn, "wb") as fh:
+        fh.write("%s %s %s\n" % (MAGIC, CACHE_VERSION, len(header_blob)))
+        fh.write(header_blob)
+        for name in names:
+            fh.write(sections[name])
+        fh.flush()
+        os.chmod(tmp_fn, 0400)
+    os.rename(tmp_fn, fn)
+
+
+class CachedFile(object):
+    """
+    A file kept beside the cache, which is only read (and checked against
+    the checksum the cache has for it) when asked for.
+    """
+
+    def __init__(self, fn, digest):
+        self.fn = fn
+        self.digest = digest
+
+    def read(self):
+        with open(self.fn, "rb") as fh:
+            contents = fh.read()
+        if _hash(contents) != self.digest:
+            raise excp.CacheFormatException("%s does not match the checksum "
+                                            "recorded in its cache" %
+                                            (self.fn))
+        return contents
+
+
+class CacheReader(object):
+    """
+    Reads the header of a cache file and its sections (on demand).
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                raise excp.CacheFormatException("Cache %s is empty" % (fn))
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.header = self._read_header()
+        except:
+            self.close()
+            raise
+
+    def _read_header(self):
+        eol = self._map.find("\n", 0, 128)
+        toks = []
+        if eol > 0:
+            toks = self._map[0:eol].split()
+        if len(toks) != 3 or toks[0] != MAGIC:
+            raise excp.CacheFormatException("%s is not a condense cache" %
+                                            (self.fn))
+        try:
+            (version, header_len) = (int(toks[1]), int(toks[2]))
+        except ValueError:
+            raise excp.CacheFormatException("Cache %s has a corrupt first "
+                                            "line" % (self.fn))
+        if version != CACHE_VERSION:
+            raise excp.CacheFormatException("Cache %s is of version %s "
+                                            "(expected version %s)" %
+                                            (self.fn, version, CACHE_VERSION))
+        self._start = eol + 1 + header_len
+        return _loads(self._map[eol + 1:self._start])
+
+    def has_section(self, name):
+        return name in self.header['sections']
+
+    def read(self, name):
+        """
+        Returns the (checksum verified) contents of a section.
+        """
+        try:
+            (offset, length, digest) = self.header['sections'][name]
+        except KeyError:
+            raise excp.CacheFormatException("Cache %s has no %r section" %
+                                            (self.fn, name))
+        offset += self._start
+        blob = self._map[offset:offset + length]
+        if len(blob) != length or _hash(blob) != digest:
+            raise excp.CacheFormatException("Section %r of cache %s is "
+                                            "corrupt" % (name, self.fn))
+        return blob
+
+    def read_json(self, name):
+        return _loads(self.read(name))
+
+    def get_files(self):
+        """
+        Returns name => CachedFile for the files kept beside the cache.
+        """
+        files = {}
+        for (name, (basename, digest)) in self.header['files'].items():
+            fn = os.path.join(os.path.dirname(self.fn), basename)
+            files[name] = CachedFile(fn, digest)
+        return files
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def save_datasource(fn, datasource, files=None):
+    """
+    Cache a datasource, its metadata goes into the cache (as a flat
+    path => value index) while its userdata (the attributes named in files)
+    is only referenced by the name of the file it is stored in (by others)
+    and a checksum of it, so that restoring the datasource does not need to
+    read the userdata in.
+    """
+    cls = datasource.__class__
+    header = {
+        'datasource': "%s:%s" % (cls.__module__, cls.__name__),
+        'created': time.time(),
+        'files': {},
+    }
+    cached_files = datasource.cached_files or {}
+    for (name, basename) in (files or {}).items():
+        contents = getattr(datasource, name, None)
+        if contents is not None:
+            header['files'][name] = [basename, _hash(contents)]
+        elif name in cached_files:
+            # still the same (unread) file as last time
+            header['files'][name] = [basename, cached_files[name].digest]
+
+    sections = {
+        'state': json.dumps(datasource.get_cache_state()),
+    }
+    metadata = datasource.metadata
+    if isinstance(metadata, data_source.LazyMetadata):
+        metadata = metadata.fetched
+    if metadata is not None:
+        sections['metadata'] = json.dumps(flatten(metadata), default=str)
+    write(fn, header, sections)
+
+
+def load_datasource(fn, sys_cfg=None):
+    """
+    Recreate a datasource from its cache.
+    """
+    reader = CacheReader(fn)
+    try:
+        cls = importer.import_entry_point(reader.header['datasource'])
+        datasource = cls(sys_cfg=sys_cfg)
+        if reader.has_section('metadata'):
+            datasource.metadata = unflatten(reader.read_json('metadata'))
+        # the userdata is only read in once it is asked for
+        datasource.cached_files = reader.get_files()
+        datasource.restore_cache_state(reader.read_json('state'))
+    finally:
+        reader.close()
+    return datasource
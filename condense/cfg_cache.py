@@ -0,0 +1,183 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+import condense.log as logging
+import condense.settings as settings
+
+log = logging.getLogger()
+
+# Bump whenever what is saved changes
+CACHE_VERSION = 1
+
+
+def _digest(path, is_dir):
+    if is_dir:
+        listing = "\n".join(sorted(os.listdir(path)))
+        return hashlib.sha1(listing).hexdigest()
+    with open(path, "rb") as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
+
+def _describe(path):
+    # (path, is_dir, mtime, size, sha1) of an input, where all but the path
+    # are None when it does not exist (so that creating it is a change)
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return (path, None, None, None, None)
+    is_dir = os.path.isdir(path)
+    return (path, is_dir, st.st_mtime, st.st_size, _digest(path, is_dir))
+
+
+def _unchanged(recorded):
+    (path, is_dir, mtime, size, digest) = recorded
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return is_dir is None
+    if is_dir is None or is_dir != os.path.isdir(path):
+        return False
+    if not is_dir and st.st_mtime == mtime and st.st_size == size:
+        return True
+    # it was touched (or is a directory), but it may still be the same
+    return _digest(path, is_dir) == digest
+
+
+def load(fn, key):
+    """
+    Returns the config saved in fn if it was saved under the same key and
+    none of the files it was built from changed since, None otherwise.
+    """
+    try:
+        with open(fn, "rb") as fh:
+            saved = marshal.loads(fh.read())
+        if (saved['version'] != CACHE_VERSION or
+            saved['python'] != tuple(sys.version_info[0:2]) or
+            saved['key'] != key):
+            return None
+        for recorded in saved['inputs']:
+            if not _unchanged(recorded):
+                log.debug("Compiled config %s is stale, %s changed", fn,
+                          recorded[0])
+                return None
+        return saved['config']
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            log.debug("Failed loading compiled config %s", fn, exc_info=True)
+    except Exception:
+        log.debug("Failed loading compiled config %s", fn, exc_info=True)
+    return None
+
+
+def save(fn, cfg, inputs, key):
+    """
+    Save a config (built from the given input files & directories) so that
+    load can return it for the same key until any of those inputs change.
+    """
+    try:
+        saved = {
+            'version': CACHE_VERSION,
+            'python': tuple(sys.version_info[0:2]),
+            'key': key,
+            'inputs': [_describe(path) for path in inputs],
+            'config': cfg,
+        }
+        blob = marshal.dumps(saved)
+    except ValueError:
+        # something yaml made that marshal can not keep
+        log.debug("Not compiling config %s, it can not be marshalled", fn)
+        return False
+    return _write(fn, blob)
+
+
+def _write(fn, blob):
+    # (atomically) write to a temporary file of our own, other processes or
+    # threads may be writing the same file at the same time
+    try:
+        (fd, tmp_fn) = tempfile.mkstemp(prefix=os.path.basename(fn),
+                                        dir=os.path.dirname(fn))
+    except OSError:
+        log.debug("Failed writing compiled config %s", fn, exc_info=True)
+        return False
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(blob)
+        os.rename(tmp_fn, fn)
+    except (IOError, OSError):
+        log.debug("Failed writing compiled config %s", fn, exc_info=True)
+        try:
+            os.unlink(tmp_fn)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def _parsed_fn(path):
+    path = os.path.abspath(path)
+    return os.path.join(settings.parse_cache_dir,
+                        "%s.marshal" % (hashlib.sha1(path).hexdigest()))
+
+
+def _parsed_key(path, st):
+    return (os.path.abspath(path), st.st_size, st.st_mtime, st.st_ino,
+            tuple(sys.version_info[0:2]))
+
+
+def load_parsed(path, st):
+    """
+    Returns a (found, parsed) tuple with what a file (with the given stat)
+    parsed into when it was last parsed, as long as it has the same path,
+    size, mtime and inode it had then.
+    """
+    try:
+        with open(_parsed_fn(path), "rb") as fh:
+            (key, parsed) = marshal.loads(fh.read())
+        if key == _parsed_key(path, st):
+            return (True, parsed)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            log.debug("Failed loading parse of %s", path, exc_info=True)
+    except Exception:
+        log.debug("Failed loading parse of %s", path, exc_info=True)
+    return (False, None)
+
+
+def save_parsed(path, st, parsed):
+    """
+    Remember what a file (with the given stat) parsed into.
+    """
+    try:
+        blob = marshal.dumps((_parsed_key(path, st), parsed))
+    except ValueError:
+        return False
+    if not os.path.isdir(settings.parse_cache_dir):
+        try:
+            os.makedirs(settings.parse_cache_dir, 0700)
+        except OSError:
+            return False
+    return _write(_parsed_fn(path), blob)
@@ -0,0 +1,255 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import Queue
+import threading
+import time
+
+from condense import exceptions as excp
+from condense import http_client
+from condense import log
+
+
+def parse_index(contents):
+    """
+    Parse a metadata directory listing into (key, resource, is_dir)
+    tuples, where resource is the path (relative to the directory) that
+    holds the keys value.
+    """
+    entries = []
+    for field in contents.splitlines():
+        field = field.strip()
+        if not field:
+            continue
+        if field.endswith("/"):
+            entries.append((field[0:-1], field, True))
+            continue
+        pos = field.find("=")
+        if pos > 0:
+            entries.append((field[pos + 1:], field[0:pos] + "/openssh-key",
+                            False))
+        else:
+            entries.append((field, field, False))
+    return entries
+
+
+def parse_value(contents):
+    if contents.find("\n") > 0:
+        return contents.split("\n")
+    return contents
+
+
+class MetadataCrawler(object):
+    """
+    Crawls an EC2 style metadata tree, fetching sibling keys concurrently
+    over the persistent connections of the shared http client.
+
+    The returned structure matches what boto's get_instance_metadata
+    returns (directories become nested dictionaries, multi-line values
+    become lists and public keys are keyed by their name).
+    """
+
+    def __init__(self, base_url, max_connections=4, timeout=5, deadline=None):
+        if not base_url.endswith("/"):
+            base_url += "/"
+        self.base_url = base_url
+        self.max_connections = max(1, int(max_connections))
+        self.timeout = timeout
+        self.deadline = deadline
+        self.client = http_client.get_client()
+        self.requests = 0
+        self.bytes = 0
+        self._stats_lock = threading.Lock()
+        self._expires = None
+
+    def _time_left(self):
+        if self._expires is None:
+            return None
+        left = self._expires - time.time()
+        if left <= 0:
+            raise excp.MetadataCrawlException("Crawl of %s exceeded its "
+                                              "deadline of %s seconds" %
+                                              (self.base_url, self.deadline))
+        return left
+
+    def fetch(self, path, allow_404=False):
+        """
+        Fetch a single path (relative to the base url).
+        """
+        timeout = self.timeout
+        left = self._time_left()
+        if left is not None and (not timeout or left < timeout):
+            timeout = left
+        url = self.base_url + path
+        try:
+            body = self.client.request(url, timeout=timeout,
+                                       pool_size=self.max_connections).contents
+        except http_client.HttpError as e:
+            if e.code == 404 and allow_404:
+                body = ''
+            else:
+                raise excp.MetadataCrawlException("Fetching %s failed with "
+                                                  "status %s" % (url, e.code),
+                                                  code=e.code)
+        with self._stats_lock:
+            self.requests += 1
+            self.bytes += len(body)
+        return body
+
+    def crawl(self, path="meta-data/"):
+        """
+        Crawl the tree rooted at the given path and return it as a nested
+        dictionary (raising if any request fails or the deadline passes).
+        """
+        started = time.time()
+        if self.deadline:
+            self._expires = started + self.deadline
+        self.requests = 0
+        self.bytes = 0
+
+        jobs = Queue.Queue()
+        cond = threading.Condition()
+        state = {
+            'pending': 0,
+            'error': None,
+        }
+
+        def add_job(job):
+            with cond:
+                state['pending'] += 1
+            jobs.put(job)
+
+        def finish_job(error=None):
+            with cond:
+                state['pending'] -= 1
+                if error and not state['error']:
+                    state['error'] = error
+                cond.notify_all()
+
+        def handle_dir(dpath, target):
+            for (key, resource, is_dir) in parse_index(self.fetch(dpath)):
+                if is_dir:
+                    target[key] = {}
+                    add_job((handle_dir, dpath + resource, target[key]))
+                else:
+                    add_job((handle_leaf, dpath + resource, (target, key)))
+
+        def handle_leaf(lpath, where):
+            (target, key) = where
+            target[key] = parse_value(self.fetch(lpath, allow_404=True))
+
+        def worker():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    break
+                (func, jpath, target) = job
+                with cond:
+                    if state['error']:
+                        job = None
+                if job is None:
+                    finish_job()
+                    continue
+                try:
+                    func(jpath, target)
+                    finish_job()
+                except Exception as e:
+                    finish_job(e)
+
+        tree = {}
+        add_job((handle_dir, path, tree))
+        workers = []
+        for i in range(0, self.max_connections):
+            w = threading.Thread(target=worker, name="crawler-%s" % (i))
+            w.daemon = True
+            w.start()
+            workers.append(w)
+
+        try:
+            with cond:
+                while state['pending'] and not state['error']:
+                    wait_for = None
+                    if self._expires is not None:
+                        wait_for = self._expires - time.time()
+                        if wait_for <= 0:
+                            state['error'] = excp.MetadataCrawlException(
+                                "Crawl of %s exceeded its deadline of %s "
+                                "seconds" % (self.base_url, self.deadline))
+                            break
+                    cond.wait(wait_for)
+        finally:
+            for _w in workers:
+                jobs.put(None)
+            self._expires = None
+
+        log.debug("Crawl of %s%s made %s requests, received %s bytes and "
+                  "took %.3f seconds", self.base_url, path, self.requests,
+                  self.bytes, time.time() - started)
+        if state['error']:
+            raise state['error']
+        return tree
+
+
+class MetadataLoader(object):
+    """
+    Loads single keys (or subtrees) of a metadata tree on demand, for use
+    as the loader of a data_source.LazyMetadata mapping.
+
+    Only plain settings are kept around so that this can be pickled along
+    with the datasource and keep loading in later stages.
+    """
+
+    def __init__(self, base_url, path="meta-data/", max_connections=4,
+                 timeout=5, deadline=None):
+        self.base_url = base_url
+        self.path = path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.deadline = deadline
+
+    def _get_crawler(self):
+        return MetadataCrawler(self.base_url,
+                               max_connections=self.max_connections,
+                               timeout=self.timeout, deadline=self.deadline)
+
+    def list_keys(self):
+        """
+        Returns a dictionary of key => (resource, is_dir) for the
+        top level of the tree.
+        """
+        md_crawler = self._get_crawler()
+        entries = parse_index(md_crawler.fetch(self.path))
+        return dict((key, (resource, is_dir))
+                    for (key, resource, is_dir) in entries)
+
+    def load(self, key, resource=None, is_dir=False):
+        """
+        Load the value (or subtree if is_dir) of the given key, raising
+        a KeyError if the metadata service does not know about it.
+        """
+        if not resource:
+            resource = key
+        md_crawler = self._get_crawler()
+        try:
+            if is_dir:
+                return md_crawler.crawl(self.path + resource.rstrip("/") +
+                                        "/")
+            contents = md_crawler.fetch(self.path + resource)
+        except excp.MetadataCrawlException as e:
+            if e.code == 404:
+                raise KeyError(key)
+            raise
+        return parse_value(contents)
@@ -18,23 +18,154 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import condense.exceptions as excp
 import condense.importer as importer
 import condense.log as logging
-import condense.settings as settings
+import condense.registry as registry
 import condense.user_data as ud
 import condense.util as util
 
+import os
 import socket
+import threading
+import UserDict
 
 log = logging.getLogger()
 DEP_FILESYSTEM = "FILESYSTEM"
 DEP_NETWORK = "NETWORK"
 
 
+class LazyMetadata(UserDict.DictMixin):
+    """
+    A metadata mapping that only fetches a key (or subtree) the first time
+    it is asked for and then remembers it.
+
+    The loader must provide list_keys(), returning key => (resource, is_dir)
+    for the top level keys, and load(key, resource, is_dir), raising a
+    KeyError for unknown keys. Other errors of the loader are raised when
+    getting a key, while checking for one ('in') treats it as not there.
+    Keys whose shape is given up front in 'known' can be loaded without
+    first listing all the keys.
+
+    Whatever was fetched is kept when pickled (along with the loader) so
+    that it can be persisted into the instance cache.
+    """
+
+    def __init__(self, loader, fetched=None, known=None):
+        self.loader = loader
+        self.fetched = dict(fetched or {})
+        self.known = dict(known or {})
+        self.index = None
+        self.missing = set()
+        self.dirty = False
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _get_index(self):
+        if self.index is None:
+            if self.loader is None:
+                self.index = {}
+            else:
+                self.index = self.loader.list_keys()
+                self.dirty = True
+        return self.index
+
+    def _load(self, key):
+        if key in self.missing or self.loader is None:
+            raise KeyError(key)
+        if self.index is not None:
+            if key not in self.index:
+                raise KeyError(key)
+            (resource, is_dir) = self.index[key]
+        elif key in self.known:
+            (resource, is_dir) = (key, self.known[key])
+        else:
+            if key not in self._get_index():
+                raise KeyError(key)
+            (resource, is_dir) = self.index[key]
+        try:
+            value = self.loader.load(key, resource, is_dir)
+        except KeyError:
+            self.missing.add(key)
+            raise
+        log.debug("Lazily loaded metadata key %r", key)
+        self.fetched[key] = value
+        self.dirty = True
+        return value
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self.fetched:
+                return self.fetched[key]
+            return self._load(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.fetched[key] = value
+            self.missing.discard(key)
+            self.dirty = True
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self.fetched[key]
+            self.missing.add(key)
+            self.dirty = True
+
+    def __contains__(self, key):
+        # a key that can not be loaded right now (the metadata service
+        # went away since) is not there, without remembering that it is
+        # missing so that it can still be loaded later
+        with self._lock:
+            if key in self.fetched:
+                return True
+            try:
+                if self.index is None and key in self.known:
+                    try:
+                        self._load(key)
+                        return True
+                    except KeyError:
+                        return False
+                return key in self._get_index() and key not in self.missing
+            except Exception:
+                log.warn("Failed loading metadata key %r", key)
+                util.logexc(log)
+                return False
+
+    def has_key(self, key):
+        return key in self
+
+    def keys(self):
+        with self._lock:
+            keys = set(self.fetched.keys())
+            keys.update(self._get_index().keys())
+            return sorted(keys - self.missing)
+
+    def materialize(self):
+        """
+        Return a plain dictionary of everything fetched so far.
+        """
+        with self._lock:
+            return dict(self.fetched)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.fetched)
+
+
 class DataSource:
     userdata = None
     metadata = None
     userdata_raw = None
+    # attribute name => cache.CachedFile of what the instance cache has
+    # (but was not read in yet), only read in when first asked for
+    cached_files = None
     cfgname = ""
     # system config (passed in from cloudinit,
     # cloud-config before input from the DataSource)
@@ -53,28 +184,119 @@ class DataSource:
 
         self.ds_cfg = util.get_cfg_by_path(self.sys_cfg,
                           ("datasource", self.cfgname), self.ds_cfg)
+        # (handlers running at once may ask for the cached files at the
+        # same time)
+        self._cached_files_lock = threading.RLock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_cached_files_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cached_files_lock = threading.RLock()
 
     def get_userdata(self):
         if self.userdata == None:
-            self.userdata = ud.preprocess_userdata(self.get_userdata_raw() or '')
+            with self._cached_files_lock:
+                if self.userdata == None:
+                    self.userdata = self._read_cached_file('userdata')
+                if self.userdata == None:
+                    self.userdata = ud.preprocess_userdata(
+                        self.get_userdata_raw() or '')
         return self.userdata
 
     def get_userdata_raw(self):
+        if self.userdata_raw == None:
+            with self._cached_files_lock:
+                if self.userdata_raw == None:
+                    self.userdata_raw = self._read_cached_file('userdata_raw')
         return self.userdata_raw
 
+    def _read_cached_file(self, name):
+        # None when the instance cache has nothing (that can be read) for it
+        cached = None
+        if self.cached_files:
+            cached = self.cached_files.pop(name, None)
+        if cached is None:
+            return None
+        try:
+            return cached.read()
+        except (IOError, excp.CacheFormatException):
+            log.warn("Failed reading the cached %s from %s", name, cached.fn)
+            util.logexc(log)
+            return None
+
     # the data sources' config_obj is a cloud-config formated
     # object that came to it from ways other than cloud-config
     # because cloud-config content would be handled elsewhere
     def get_config_obj(self):
         return {}
 
-    def device_name_to_device(self, _name):
+    # plain (json-able) state to keep in the instance cache besides the
+    # metadata & userdata, given back to restore_cache_state when the
+    # datasource is recreated from the cache
+    def get_cache_state(self):
+        return {}
+
+    def restore_cache_state(self, state):
+        pass
+
+    def device_name_to_device(self, name):
         # translate a 'name' to a device
-        # the primary function at this point is on ec2
-        # to consult metadata service, that has
+        # consult the (ec2 style) metadata, that has
         #  ephemeral0: sdb
         # and return 'sdb' for input 'ephemeral0'
-        return None
+        if self.metadata is None:
+            return None
+        if 'block-device-mapping' not in self.metadata:
+            return None
+
+        found = None
+        for entname, device in self.metadata['block-device-mapping'].items():
+            if entname == name:
+                found = device
+                break
+            # LP: #513842 mapping in Euca has 'ephemeral' not 'ephemeral0'
+            if entname == "ephemeral" and name == "ephemeral0":
+                found = device
+        if found == None:
+            log.debug("unable to convert %s to a device" % name)
+            return None
+
+        # LP: #611137
+        # the metadata service may believe that devices are named 'sda'
+        # when the kernel named them 'vda' or 'xvda'
+        # we want to return the correct value for what will actually
+        # exist in this instance
+        mappings = {"sd": ("vd", "xvd")}
+        ofound = found
+        short = os.path.basename(found)
+
+        if not found.startswith("/"):
+            found = "/dev/%s" % found
+
+        if os.path.exists(found):
+            return found
+
+        for nfrom, tlist in mappings.items():
+            if not short.startswith(nfrom):
+                continue
+            for nto in tlist:
+                cand = "/dev/%s%s" % (nto, short[len(nfrom):])
+                if os.path.exists(cand):
+                    log.debug("remapped device name %s => %s" % (found, cand))
+                    return cand
+
+        # on t1.micro, ephemeral0 will appear in block-device-mapping from
+        # metadata, but it will not exist on disk (and never will)
+        # at this pint, we've verified that the path did not exist
+        # in the special case of 'ephemeral0' return None to avoid bogus
+        # fstab entry (LP: #744019)
+        if name == "ephemeral0":
+            return None
+        return ofound
 
     def get_locale(self):
         return 'en_US.UTF-8'
@@ -82,6 +304,11 @@ class DataSource:
     def get_local_mirror(self):
         return None
 
+    def get_current_instance_id(self, timeout=None):
+        # the instance-id the source reports right now (without using
+        # anything cached), None if that can not be cheaply found out
+        return None
+
     def get_instance_id(self):
         if 'instance-id' not in self.metadata:
             return "iid-datasource"
@@ -128,18 +355,26 @@ class DataSource:
 
 
 # return a list of classes that have the same depends as 'depends'
-# iterate through cfg_list, loading "DataSourceCollections" modules
-# and calling their "get_datasource_list".
+# iterate through cfg_list, looking up "DataSourceCollections" modules
+# in the registry (only importing the classes that match) or, for those
+# it has no datasources listed for, calling their "get_datasource_list".
 # return an ordered list of classes that match
 def list_sources(cfg_list, depends):
     retlist = []
+    depset = set(depends)
     for ds_coll in cfg_list:
-        mod_name = settings.src_mod_tpl % (ds_coll)
-        log.debug("Importing source module: %s", mod_name)
-        mod = importer.import_module(mod_name)
-        lister = getattr(mod, "get_datasource_list", None)
-        if lister:
-            retlist.extend(lister(depends))
+        found = registry.get_registry().get_source(ds_coll)
+        if found['datasources'] is None:
+            log.debug("Importing source module: %s", found['module'])
+            mod = importer.import_module(found['module'])
+            lister = getattr(mod, "get_datasource_list", None)
+            if lister:
+                retlist.extend(lister(depends))
+            continue
+        for (entry_point, deps) in found['datasources']:
+            if depset == set(deps):
+                log.debug("Importing source: %s", entry_point)
+                retlist.append(importer.import_entry_point(entry_point))
     return retlist
 
 
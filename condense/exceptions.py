@@ -4,3 +4,17 @@ class DataSourceNotFoundException(Exception):
     pass
 
 
+class CacheFormatException(Exception):
+    pass
+
+
+class ProcessTimeoutException(Exception):
+    def __init__(self, msg, result=None):
+        Exception.__init__(self, msg)
+        self.result = result
+
+
+class MetadataCrawlException(Exception):
+    def __init__(self, msg, code=None):
+        Exception.__init__(self, msg)
+        self.code = code
@@ -20,14 +20,16 @@
 #
 
 import os
+import Queue
 import subprocess
 import sys
+import threading
 import time
 import traceback
-import yaml
 
 from condense import (per_instance, per_always, per_once,
                       get_ipath_cur, util)
+from condense import registry
 
 
 # reads a cloudconfig module list, returns
@@ -50,27 +52,173 @@ def read_cc_modules(cfg, name):
     return(module_list)
 
 
+# Handlers may declare (as module attributes, which condense.registry indexes)
+# the handlers they have to run after, when those run in the same stage, and
+# the resources (files, devices, settings...) they change:
+#
+#   depends = ["set_hostname"]
+#   resources = ["/etc/hosts"]
+#
+# A stage runs its handlers on a pool of (handler_workers) threads, starting
+# a handler once the handlers it depends on finished and no handler listed
+# before it that shares a resource with it is still running. Handlers that
+# do not declare their resources may change anything and so run alone. With
+# 1 they run one after the other (in the order listed, but after those they
+# depend on).
+DEF_HANDLER_WORKERS = 4
+
+
+def _parse_cc_module(cfg_mod):
+    name = cfg_mod[0]
+    freq = None
+    run_args = []
+    if len(cfg_mod) > 1:
+        freq = cfg_mod[1]
+    if len(cfg_mod) > 2:
+        run_args = cfg_mod[2:]
+    return (name, freq, run_args)
+
+
+def _get_declarations(cc, name, log):
+    # (depends, resources) a handler declares, where resources are None when
+    # it does not declare them (a handler the registry does not know of is
+    # left for running it to fail)
+    try:
+        info = cc.get_handler_info(name)
+    except Exception:
+        log.debug("Could not look up handler %s to read its dependencies",
+                  name, exc_info=True)
+        return ([], None)
+    resources = info['resources']
+    if resources is not None:
+        resources = set(resources)
+    return (info['depends'], resources)
+
+
+def _order_cc_modules(names, depends, log):
+    # topological order of the handlers (by index), where the handler listed
+    # first wins whenever more than one could go next
+    by_name = {}
+    for (i, name) in enumerate(names):
+        by_name.setdefault(registry.normalize_name(name), []).append(i)
+    after = []
+    for (i, deps) in enumerate(depends):
+        found = set()
+        for dep in deps:
+            found.update(j for j in by_name.get(dep, []) if j != i)
+        after.append(found)
+
+    waiting = set(range(0, len(names)))
+    order = []
+    while waiting:
+        ready = [i for i in sorted(waiting) if not (after[i] & waiting)]
+        if not ready:
+            # a dependency cycle, break it at the handler listed first
+            i = min(waiting)
+            log.warn("Handler %s is part of a dependency cycle (with %s), "
+                     "running it first", names[i],
+                     ", ".join(names[j] for j in sorted(after[i] & waiting)))
+            ready = [i]
+        waiting.remove(ready[0])
+        order.append(ready[0])
+    # what each handler waits on, with the cycles broken
+    for (pos, i) in enumerate(order):
+        earlier = set(order[0:pos])
+        after[i] = set(j for j in after[i] if j in earlier)
+    return (order, after)
+
+
+def _conflicts(resources_a, resources_b):
+    if resources_a is None or resources_b is None:
+        return True
+    return bool(resources_a & resources_b)
+
+
+def _run_cc_module(cc, cfg_mod, log):
+    (name, freq, run_args) = _parse_cc_module(cfg_mod)
+    try:
+        log.debug("Handling %s with freq=%s and args=%s" %
+            (name, freq, run_args))
+        cc.handle(name, run_args, freq=freq)
+        return True
+    except:
+        log.warn(traceback.format_exc())
+        log.error("Config handling of %s, %s, %s failed" %
+            (name, freq, run_args))
+        return False
+
+
 def run_cc_modules(cc, module_list, log):
-    failures = []
-    for cfg_mod in module_list:
-        name = cfg_mod[0]
-        freq = None
-        run_args = []
-        if len(cfg_mod) > 1:
-            freq = cfg_mod[1]
-        if len(cfg_mod) > 2:
-            run_args = cfg_mod[2:]
-
-        try:
-            log.debug("Handling %s with freq=%s and args=%s" %
-                (name, freq, run_args))
-            cc.handle(name, run_args, freq=freq)
-        except:
-            log.warn(traceback.format_exc())
-            log.error("Config handling of %s, %s, %s failed" %
-                (name, freq, run_args))
-            failures.append(name)
-    return failures
+    names = [_parse_cc_module(cfg_mod)[0] for cfg_mod in module_list]
+    depends = []
+    resources = []
+    for name in names:
+        (deps, res) = _get_declarations(cc, name, log)
+        depends.append(deps)
+        resources.append(res)
+    (order, after) = _order_cc_modules(names, depends, log)
+
+    workers = util.get_cfg_option_str(cc.cfg, "handler_workers",
+                                      DEF_HANDLER_WORKERS)
+    try:
+        workers = max(1, int(workers))
+    except (TypeError, ValueError):
+        log.warn("Invalid handler_workers %r, using %s", workers,
+                 DEF_HANDLER_WORKERS)
+        workers = DEF_HANDLER_WORKERS
+
+    failed = set()
+    if workers == 1 or len(order) <= 1:
+        for i in order:
+            if not _run_cc_module(cc, module_list[i], log):
+                failed.add(i)
+        return [names[i] for i in sorted(failed)]
+
+    # a handler waits on those it depends on and on those before it (in the
+    # order they are run in) that it conflicts with
+    for (pos, i) in enumerate(order):
+        for j in order[0:pos]:
+            if _conflicts(resources[i], resources[j]):
+                after[i].add(j)
+
+    jobs = Queue.Queue()
+    cond = threading.Condition()
+    finished = set()
+
+    def worker():
+        while True:
+            i = jobs.get()
+            if i is None:
+                break
+            ok = _run_cc_module(cc, module_list[i], log)
+            with cond:
+                finished.add(i)
+                if not ok:
+                    failed.add(i)
+                cond.notify_all()
+
+    threads = []
+    for n in range(0, min(workers, len(order))):
+        t = threading.Thread(target=worker, name="handler-%s" % (n))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    started = set()
+    try:
+        with cond:
+            while len(finished) < len(order):
+                for i in order:
+                    if i not in started and after[i] <= finished:
+                        started.add(i)
+                        jobs.put(i)
+                cond.wait()
+    finally:
+        for _t in threads:
+            jobs.put(None)
+    for t in threads:
+        t.join()
+    return [names[i] for i in sorted(failed)]
 
 
 def run_per_instance(name, func, args, clear_on_fail=False):
@@ -24,6 +24,9 @@ from condense import per_always
 from condense import util
 frequency = per_always
 
+# How many seconds bootcmd (all of it) may take unless bootcmd_timeout says
+DEF_BOOTCMD_TIMEOUT = 300
+
 
 def handle(_name, cfg, cloud, log, _args):
     if "bootcmd" not in cfg:
@@ -38,7 +41,9 @@ def handle(_name, cfg, cloud, log, _args):
     try:
         env = os.environ.copy()
         env['INSTANCE_ID'] = cloud.get_instance_id()
-        util.subp(['/bin/sh'], content, env=env)
+        timeout = float(util.get_cfg_option_str(cfg, "bootcmd_timeout",
+                                                DEF_BOOTCMD_TIMEOUT))
+        util.subp(['/bin/sh'], content, env=env, timeout=timeout)
     except:
         log.warn("Failed to run commands from bootcmd")
         raise
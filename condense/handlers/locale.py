@@ -19,17 +19,31 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import subprocess
 import traceback
 
+from condense import exceptions as excp
+from condense import process
 from condense import util
+resources = ["locale"]
 
+# How many seconds locale-gen (and update-locale) may take unless
+# locale_timeout says
+DEF_LOCALE_TIMEOUT = 300
 
-def apply_locale(locale, cfgfile):
+
+def _run(args, timeout):
+    result = process.run(args, timeout=timeout)
+    if result.timed_out:
+        raise excp.ProcessTimeoutException("`%s` did not finish in %s "
+                                           "seconds" % (" ".join(args),
+                                                        timeout), result)
+
+
+def apply_locale(locale, cfgfile, timeout=DEF_LOCALE_TIMEOUT):
     if os.path.exists('/usr/sbin/locale-gen'):
-        subprocess.Popen(['locale-gen', locale]).communicate()
+        _run(['locale-gen', locale], timeout)
     if os.path.exists('/usr/sbin/update-locale'):
-        subprocess.Popen(['update-locale', locale]).communicate()
+        _run(['update-locale', locale], timeout)
     util.render_to_file('default-locale', cfgfile, {'locale': locale})
 
 
@@ -43,13 +57,15 @@ def handle(_name, cfg, cloud, log, args):
 
     locale_cfgfile = util.get_cfg_option_str(cfg, "locale_configfile",
                                              "/etc/default/locale")
+    timeout = float(util.get_cfg_option_str(cfg, "locale_timeout",
+                                            DEF_LOCALE_TIMEOUT))
 
     if not locale:
         return
 
     log.debug("Setting locale to %s" % locale)
     try:
-        apply_locale(locale, locale_cfgfile)
+        apply_locale(locale, locale_cfgfile, timeout)
     except Exception as e:
         log.debug(traceback.format_exc(e))
         raise Exception("Failed to apply locale %s" % locale)
@@ -23,6 +23,11 @@ import re
 from string import whitespace  # pylint: disable=W0402
 
 from condense import util
+resources = ["mounts", "/etc/fstab"]
+
+# How many seconds 'mount -a' (or 'swapon -a') may take unless mount_timeout
+# says
+DEF_MOUNT_TIMEOUT = 120
 
 
 def is_mdname(name):
@@ -160,9 +165,12 @@ def handle(_name, cfg, cloud, log, _args):
     fstab.truncate()
     fstab.close()
 
+    timeout = float(util.get_cfg_option_str(cfg, "mount_timeout",
+                                            DEF_MOUNT_TIMEOUT))
+
     if needswap:
         try:
-            util.subp(["swapon", "-a"])
+            util.subp(["swapon", "-a"], timeout=timeout)
         except:
             log.warn("Failed to enable swap")
 
@@ -175,6 +183,6 @@ def handle(_name, cfg, cloud, log, _args):
             log.warn("Failed to make '%s' config-mount", d)
 
     try:
-        util.subp(["mount", "-a"])
+        util.subp(["mount", "-a"], timeout=timeout)
     except:
         log.warn("'mount -a' failed")
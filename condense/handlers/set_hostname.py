@@ -22,6 +22,7 @@ import os
 import re
 
 from condense import util
+resources = ["hostname", "/etc/hostname", "/etc/sysconfig/network"]
 
 
 def handle(_name, cfg, cloud, log, _args):
@@ -23,6 +23,7 @@ import shutil
 
 from condense import (util, per_instance)
 frequency = per_instance
+resources = ["/etc/timezone", "/etc/localtime", "/etc/sysconfig/clock"]
 
 
 def handle(_name, cfg, _cloud, log, args):
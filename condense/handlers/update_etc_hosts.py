@@ -20,6 +20,8 @@
 
 from condense import (util, per_always)
 frequency = per_always
+depends = ["set_hostname"]
+resources = ["/etc/hosts"]
 
 
 def handle(_name, cfg, cloud, log, _args):
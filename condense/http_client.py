@@ -0,0 +1,332 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import gzip
+import httplib
+import Queue
+import socket
+import StringIO
+import threading
+import time
+import urlparse
+
+import condense.log as logging
+import condense.resolver as resolver
+
+log = logging.getLogger()
+
+# How many idle connections we keep around (per host), unless a caller asks
+# for more
+POOL_SIZE = 4
+
+# How many redirects we will follow before giving up
+MAX_REDIRECTS = 5
+
+REDIRECT_CODES = (httplib.MOVED_PERMANENTLY, httplib.FOUND,
+                  httplib.SEE_OTHER, httplib.TEMPORARY_REDIRECT)
+
+# Requests that can be sent again (if the connection they went out on broke)
+# without any harm done, the others never go out on a connection that may
+# have gone stale
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+
+class HttpError(IOError):
+    def __init__(self, url, code, msg=None):
+        if not msg:
+            msg = "%s returned http status %s" % (url, code)
+        IOError.__init__(self, msg)
+        self.url = url
+        self.code = code
+
+
+class Response(object):
+    def __init__(self, url, code, headers, contents):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.contents = contents
+
+    def ok(self):
+        return 200 <= self.code < 300
+
+
+class HTTPConnection(httplib.HTTPConnection):
+    """
+    A http connection that connects to the addresses the resolver already
+    has for its host (if any) instead of looking the host up again.
+    """
+
+    def connect(self):
+        addrs = resolver.lookup(self.host)
+        if not addrs:
+            return httplib.HTTPConnection.connect(self)
+        last_err = None
+        for (family, socktype, proto, sockaddr) in addrs:
+            sockaddr = (sockaddr[0], self.port) + tuple(sockaddr[2:])
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(self.timeout)
+                sock.connect(sockaddr)
+                self.sock = sock
+                return
+            except socket.error as e:
+                last_err = e
+                if sock is not None:
+                    sock.close()
+        raise last_err
+
+
+class ConnectionPool(object):
+    """
+    A pool of idle persistent (HTTP/1.1 keep-alive) connections to a
+    single host. New connections are made whenever no idle one is around
+    but at most 'size' idle connections are kept for reuse.
+    """
+
+    def __init__(self, scheme, host, port=None, size=POOL_SIZE):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.size = max(1, int(size))
+        self._free = Queue.LifoQueue()
+
+    def new_connection(self, timeout):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=timeout)
+        return HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def get(self, timeout=None):
+        """
+        Returns a (connection, reused) tuple, where reused tells if the
+        connection came from the pool (and thus may have gone stale).
+        """
+        try:
+            conn = self._free.get_nowait()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return (conn, True)
+        except Queue.Empty:
+            return (self.new_connection(timeout), False)
+
+    def put(self, conn):
+        if self._free.qsize() >= self.size:
+            conn.close()
+        else:
+            self._free.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._free.get_nowait()
+            except Queue.Empty:
+                break
+            conn.close()
+
+
+class HttpClient(object):
+    """
+    A http client that shares keep-alive connection pools (one per host)
+    between all of its users, transparently handles gzip encoded
+    responses and keeps request & latency counters around.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _get_pool(self, scheme, host, port, size=None):
+        key = (scheme, host, port)
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(scheme, host, port,
+                                                  size=self.pool_size)
+            pool = self._pools[key]
+            if size and size > pool.size:
+                # (keep as many as the caller uses at once)
+                pool.size = int(size)
+            return pool
+
+    def _record(self, host, latency, nbytes, failed=False):
+        with self._lock:
+            if host not in self._stats:
+                self._stats[host] = {
+                    'requests': 0,
+                    'failures': 0,
+                    'connections': 0,
+                    'bytes': 0,
+                    'latency': 0.0,
+                    'max_latency': 0.0,
+                }
+            hstats = self._stats[host]
+            hstats['requests'] += 1
+            if failed:
+                hstats['failures'] += 1
+            hstats['bytes'] += nbytes
+            hstats['latency'] += latency
+            hstats['max_latency'] = max(hstats['max_latency'], latency)
+
+    def _record_connection(self, host):
+        with self._lock:
+            if host in self._stats:
+                self._stats[host]['connections'] += 1
+
+    def _perform(self, pool, method, path, body, headers, timeout):
+        if method in IDEMPOTENT_METHODS:
+            (conn, reused) = pool.get(timeout)
+        else:
+            (conn, reused) = (pool.new_connection(timeout), False)
+        try:
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            contents = resp.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            # The server may have closed an idle keep-alive connection on
+            # us, which only shows up once we try to use it, so retry once
+            # on a brand new connection.
+            (conn, reused) = (pool.new_connection(timeout), False)
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                contents = resp.read()
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            pool.put(conn)
+        return (resp, contents, reused)
+
+    def request(self, url, data=None, headers=None, timeout=None,
+                method=None, pool_size=None):
+        """
+        Make a request to the given url (a POST if data is provided, a GET
+        otherwise) following redirects. Returns a Response object and raises
+        a HttpError for non-2xx responses.
+
+        Callers making (up to) pool_size requests to the same host at once
+        can have as many idle connections to it kept around.
+        """
+        if not method:
+            if data is None:
+                method = "GET"
+            else:
+                method = "POST"
+        req_headers = {
+            'Accept-Encoding': 'gzip',
+        }
+        if data is not None:
+            req_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if headers:
+            req_headers.update(headers)
+
+        for _i in range(0, MAX_REDIRECTS + 1):
+            pieces = urlparse.urlparse(url)
+            host = pieces.hostname
+            path = pieces.path or "/"
+            if pieces.query:
+                path = "%s?%s" % (path, pieces.query)
+            pool = self._get_pool(pieces.scheme, host, pieces.port,
+                                  size=pool_size)
+            start = time.time()
+            try:
+                (resp, contents, reused) = self._perform(pool, method, path,
+                                                         data, req_headers,
+                                                         timeout)
+            except:
+                self._record(host, time.time() - start, 0, failed=True)
+                raise
+            self._record(host, time.time() - start, len(contents),
+                         failed=(resp.status >= 400))
+            if not reused:
+                self._record_connection(host)
+
+            if resp.status in REDIRECT_CODES and resp.getheader('location'):
+                url = urlparse.urljoin(url, resp.getheader('location'))
+                if resp.status == httplib.SEE_OTHER:
+                    (method, data) = ("GET", None)
+                continue
+
+            if resp.getheader('content-encoding', '').lower() == 'gzip':
+                contents = gzip.GzipFile(None, "rb", 1,
+                                         StringIO.StringIO(contents)).read()
+            response = Response(url, resp.status, dict(resp.getheaders()),
+                                contents)
+            if not response.ok():
+                raise HttpError(url, resp.status)
+            return response
+
+        raise HttpError(url, resp.status,
+                        "Too many redirects (%s) fetching %s" %
+                        (MAX_REDIRECTS, url))
+
+    def get_stats(self):
+        with self._lock:
+            return dict((host, dict(hstats))
+                        for (host, hstats) in self._stats.items())
+
+    def log_stats(self, header="Http client stats"):
+        for (host, hstats) in sorted(self.get_stats().items()):
+            avg = 0.0
+            if hstats['requests']:
+                avg = hstats['latency'] / hstats['requests']
+            log.info("%s for %s: %s requests (%s failed) over %s connections,"
+                     " %s bytes, %.3f avg & %.3f max latency (seconds)",
+                     header, host, hstats['requests'], hstats['failures'],
+                     hstats['connections'], hstats['bytes'], avg,
+                     hstats['max_latency'])
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools = {}
+
+
+# The client shared by everyone in this process
+_client = HttpClient()
+
+
+def get_client():
+    return _client
+
+
+def request(url, data=None, headers=None, timeout=None, method=None,
+            pool_size=None):
+    return _client.request(url, data=data, headers=headers,
+                           timeout=timeout, method=method,
+                           pool_size=pool_size)
+
+
+def get_stats():
+    return _client.get_stats()
+
+
+def log_stats(header="Http client stats"):
+    _client.log_stats(header)
@@ -55,7 +55,10 @@ FileHandler = logging.FileHandler
 SysLogHandler = SysLogHandler
 
 
-def setupLogging(log_level, fn, format='%(levelname)s: @%(name)s : %(message)s'):
+LOG_FORMAT = '%(levelname)s: @%(name)s : %(message)s'
+
+
+def setupLogging(log_level, fn, format=LOG_FORMAT):
     root_logger = getLogger()
     console_logger = StreamHandler(sys.stdout)
     console_logger.setFormatter(Formatter(format))
@@ -21,8 +21,6 @@
 
 from condense import util
 
-from prettytable import PrettyTable
-
 
 def netdev_info(empty=""):
     fields = ("hwaddr", "addr", "bcast", "mask")
@@ -85,6 +83,7 @@ def route_info():
 
 
 def net_info():
+    from prettytable import PrettyTable
     lines = []
     try:
         netdev = netdev_info(empty=".")
@@ -0,0 +1,254 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import os
+import select
+import signal
+import subprocess
+import time
+
+import condense.log as logging
+
+log = logging.getLogger()
+
+# How much of each of stdout & stderr is kept (the rest is only logged)
+DEF_CAPTURE_LIMIT = 1024 * 1024
+
+# How long a command that timed out gets to exit after a SIGTERM before it
+# (and whatever it started) is sent a SIGKILL
+DEF_KILL_GRACE = 5
+
+# Longest line logged in one go
+MAX_LINE = 4096
+
+READ_SIZE = 65536
+
+# How often to check whether the command exited while waiting on its output
+POLL_INTERVAL = 0.1
+
+# How long to keep reading the output of a command after it exited, what it
+# left running in the background may keep its output open far longer
+DRAIN_TIME = 0.5
+
+
+class ProcessResult(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.pid = None
+        self.returncode = None
+        self.stdout = ''
+        self.stderr = ''
+        # stream name => whether what was captured of it was cut short
+        self.truncated = {'stdout': False, 'stderr': False}
+        self.timed_out = False
+        self.rusage = None
+        self.elapsed = None
+
+
+class _Stream(object):
+    # what is read from one of the pipes, logged line by line and kept up to
+    # a limit
+
+    def __init__(self, name, cmd, limit, log_output):
+        self.name = name
+        self.cmd = cmd
+        self.limit = limit
+        self.log_output = log_output
+        self.captured = []
+        self.size = 0
+        self.truncated = False
+        self.partial = ''
+
+    def feed(self, data):
+        room = self.limit - self.size
+        if room > 0:
+            kept = data[0:room]
+            self.captured.append(kept)
+            self.size += len(kept)
+        if len(data) > room:
+            self.truncated = True
+        if not self.log_output:
+            return
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self._log(line)
+        while len(self.partial) > MAX_LINE:
+            self._log(self.partial[0:MAX_LINE])
+            self.partial = self.partial[MAX_LINE:]
+
+    def finish(self):
+        if self.partial:
+            self._log(self.partial)
+            self.partial = ''
+        return "".join(self.captured)
+
+    def _log(self, line):
+        log.debug("[%s %s] %s", self.cmd, self.name, line.rstrip("\r"))
+
+
+def _decode_status(status):
+    # the same as what subprocess makes of it
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _signal_group(pid, signum):
+    try:
+        os.killpg(pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def run(args, input_=None, env=None, timeout=None,
+        capture_limit=DEF_CAPTURE_LIMIT, kill_grace=DEF_KILL_GRACE,
+        log_output=True):
+    """
+    Run a command (in a process group of its own), feeding it input_ and
+    logging what it writes (line by line) while it runs. At most
+    capture_limit bytes of each of its stdout & stderr are kept. If it is
+    still running once timeout seconds pass it (and whatever it started) is
+    sent a SIGTERM, followed by a SIGKILL kill_grace seconds later if still
+    around.
+
+    It is done once the command itself exited, what it started in the
+    background (and left running) is not waited for, even when it keeps
+    the same output open.
+
+    Returns a ProcessResult.
+    """
+    result = ProcessResult(args)
+    cmd = os.path.basename(args[0])
+    started = time.time()
+    sp = subprocess.Popen(args, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, stdin=subprocess.PIPE,
+                          env=env, preexec_fn=os.setpgrp, close_fds=True)
+    result.pid = sp.pid
+    out = _Stream('stdout', cmd, capture_limit, log_output)
+    err = _Stream('stderr', cmd, capture_limit, log_output)
+    streams = {
+        sp.stdout.fileno(): out,
+        sp.stderr.fileno(): err,
+    }
+    readers = list(streams.keys())
+    writers = []
+    pending = input_ or ''
+    if pending:
+        writers.append(sp.stdin.fileno())
+    else:
+        sp.stdin.close()
+
+    # when to (next) send it a SIGTERM or SIGKILL
+    deadline = None
+    if timeout is not None:
+        deadline = started + timeout
+    # when to stop reading what is left once it exited
+    drain_until = None
+    status = None
+    rusage = None
+    try:
+        while True:
+            if status is None:
+                (pid, exited, used) = os.wait4(sp.pid, os.WNOHANG)
+                if pid:
+                    (status, rusage) = (exited, used)
+                    # what it started (and left running) may keep its
+                    # output open, only read what is left for a little
+                    drain_until = time.time() + DRAIN_TIME
+                    if writers:
+                        writers = []
+                        sp.stdin.close()
+            now = time.time()
+            if status is not None:
+                if not readers:
+                    break
+                if now >= drain_until:
+                    log.debug("`%s` exited but what it started still has "
+                              "its output open, no longer reading it", cmd)
+                    break
+                wait_for = drain_until - now
+            else:
+                if deadline is not None and now >= deadline:
+                    if not result.timed_out:
+                        log.warn("`%s` did not finish in %s seconds, "
+                                 "terminating it", cmd, timeout)
+                        result.timed_out = True
+                        _signal_group(sp.pid, signal.SIGTERM)
+                        deadline = now + kill_grace
+                    else:
+                        log.warn("`%s` did not exit %s seconds after being "
+                                 "terminated, killing it", cmd, kill_grace)
+                        _signal_group(sp.pid, signal.SIGKILL)
+                        deadline = None
+                # (checking on whether it exited every so often)
+                wait_for = POLL_INTERVAL
+                if deadline is not None:
+                    wait_for = max(0, min(wait_for, deadline - now))
+
+            try:
+                (readable, writable, _errored) = select.select(readers,
+                                                               writers, [],
+                                                               wait_for)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in writable:
+                try:
+                    written = os.write(fd, pending[0:select.PIPE_BUF])
+                    pending = pending[written:]
+                except OSError as e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    # it stopped reading what it is given
+                    pending = ''
+                if not pending:
+                    writers.remove(fd)
+                    sp.stdin.close()
+            for fd in readable:
+                data = os.read(fd, READ_SIZE)
+                if data:
+                    streams[fd].feed(data)
+                else:
+                    readers.remove(fd)
+    finally:
+        if status is None:
+            _signal_group(sp.pid, signal.SIGKILL)
+            (_pid, status, rusage) = os.wait4(sp.pid, 0)
+        # (so that the Popen object does not go looking for it)
+        sp.returncode = _decode_status(status)
+        for fh in (sp.stdin, sp.stdout, sp.stderr):
+            fh.close()
+
+    result.returncode = sp.returncode
+    result.rusage = rusage
+    result.elapsed = time.time() - started
+    result.stdout = out.finish()
+    result.stderr = err.finish()
+    result.truncated = {'stdout': out.truncated, 'stderr': err.truncated}
+    log.debug("`%s` exited with %s after %.3f seconds (user %.3f, system "
+              "%.3f seconds, max rss %s KB)", cmd, result.returncode,
+              result.elapsed, rusage.ru_utime, rusage.ru_stime,
+              rusage.ru_maxrss)
+    for name in ('stdout', 'stderr'):
+        if result.truncated[name]:
+            log.debug("Only kept the first %s bytes of the %s of `%s`",
+                      capture_limit, name, cmd)
+    return result
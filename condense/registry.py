@@ -0,0 +1,439 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+An index of the handlers & datasources there are, so that finding out what
+a handler (or datasource) is, runs as and depends on does not need to
+import it.
+
+Besides the modules in condense/handlers and condense/sources, others can
+provide them through setuptools entry points, for example:
+
+    entry_points={
+        'condense.handlers': ['my_handler = my_package.my_handler'],
+        'condense.sources': ['my_source = my_package.my_source'],
+    }
+
+The index is built without importing any of those modules (or
+pkg_resources), by reading the entry_points.txt files found on sys.path and
+parsing what the modules declare (their frequency, depends, resources and
+datasources) out of their source. Only modules whose declarations are not
+simple enough for that (or that have no source) are imported. It is rebuilt
+when any of the files it was built from changed or when a name that it does
+not know of is asked for, and is kept in settings.registry_index between
+runs.
+"""
+
+import ast
+import ConfigParser
+import glob
+import imp
+import os
+import sys
+import threading
+
+import condense.cfg_cache as cfg_cache
+import condense.importer as importer
+import condense.log as logging
+import condense.settings as settings
+
+log = logging.getLogger()
+
+# Bump whenever what is indexed changes
+REGISTRY_VERSION = 2
+
+HANDLER_GROUP = "condense.handlers"
+SOURCE_GROUP = "condense.sources"
+
+# What the modules declare (at their top level) that is indexed
+DECLARATIONS = ('frequency', 'depends', 'resources', 'datasources')
+
+
+class NotStatic(Exception):
+    # a declaration that can not be worked out without running the module
+    pass
+
+
+def normalize_name(name):
+    return str(name).replace("-", "_")
+
+
+def find_source(mod_name):
+    """
+    Returns the source file of a module (the __init__.py of a package), or
+    None when it has none, finding it the way importing it would without
+    importing it (or the packages it is in).
+    """
+    path = None
+    found = None
+    for part in mod_name.split("."):
+        try:
+            (fh, fn, (_suffix, _mode, kind)) = imp.find_module(part, path)
+        except ImportError:
+            return None
+        if fh:
+            fh.close()
+        if kind == imp.PKG_DIRECTORY:
+            path = [fn]
+            found = os.path.join(fn, "__init__.py")
+        elif kind == imp.PY_SOURCE:
+            path = None
+            found = fn
+        else:
+            return None
+    if found is None or not os.path.isfile(found):
+        return None
+    return found
+
+
+def _package_modules(mod_tpl):
+    # (name, module name) of the modules in the package the template is
+    # for, found without importing them
+    package = find_source(mod_tpl.rsplit(".", 1)[0])
+    path = os.path.dirname(package)
+    found = []
+    for fn in sorted(os.listdir(path)):
+        (name, ext) = os.path.splitext(fn)
+        if ext == ".py" and not name.startswith("_"):
+            found.append((name, mod_tpl % (name)))
+    return (path, found)
+
+
+def _entry_point_files():
+    found = []
+    for path in sys.path:
+        if not path or not os.path.isdir(path):
+            continue
+        for pattern in ("*.egg-info", "*.dist-info", "EGG-INFO"):
+            for info in sorted(glob.glob(os.path.join(path, pattern))):
+                fn = os.path.join(info, "entry_points.txt")
+                if os.path.isfile(fn):
+                    found.append(fn)
+    return found
+
+
+def _entry_points(group, files):
+    # (name, module name) of what the (installed) distributions provide for
+    # the group, read from their entry_points.txt like pkg_resources would
+    found = []
+    for fn in files:
+        parser = ConfigParser.RawConfigParser()
+        # (entry point names are case sensitive)
+        parser.optionxform = str
+        try:
+            parser.read([fn])
+            if not parser.has_section(group):
+                continue
+            for (name, value) in parser.items(group):
+                mod_name = value.split("[", 1)[0].split(":", 1)[0].strip()
+                found.append((normalize_name(name.strip()), mod_name))
+        except ConfigParser.Error:
+            log.warn("Failed reading entry points from %s", fn, exc_info=True)
+    return found
+
+
+class _Declarations(object):
+    # what a module declares at its top level, worked out from its source
+
+    def __init__(self, mod_name, fn):
+        self.mod_name = mod_name
+        with open(fn, "rb") as fh:
+            tree = ast.parse(fh.read(), fn)
+        # name => ('module', module name), ('from', module name, attribute)
+        # or ('class',) for what is bound at the top level
+        self.names = {}
+        self.assigned = {}
+        package = mod_name
+        if not fn.endswith("__init__.py"):
+            package = mod_name.rpartition(".")[0]
+        for node in tree.body:
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    if alias.asname:
+                        self.names[alias.asname] = ('module', alias.name)
+                    else:
+                        top = alias.name.split(".")[0]
+                        self.names[top] = ('module', top)
+            elif isinstance(node, ast.ImportFrom):
+                base = node.module or ''
+                if node.level:
+                    parent = package.split(".")
+                    parent = parent[0:len(parent) - (node.level - 1)]
+                    base = ".".join([p for p in parent + [base] if p])
+                for alias in node.names:
+                    self.names[alias.asname or alias.name] = ('from', base,
+                                                              alias.name)
+            elif isinstance(node, ast.ClassDef):
+                self.names[node.name] = ('class',)
+            elif isinstance(node, ast.Assign):
+                for target in node.targets:
+                    if isinstance(target, ast.Name):
+                        self.names.pop(target.id, None)
+                        if target.id in DECLARATIONS:
+                            self.assigned[target.id] = node.value
+                    else:
+                        self._bound_in(target)
+            elif isinstance(node, ast.FunctionDef):
+                if node.name in DECLARATIONS:
+                    self.assigned[node.name] = None
+            else:
+                # (conditionally) bound in some other way, which needs
+                # running the module to find out
+                self._bound_in(node)
+
+    def _bound_in(self, node):
+        for sub in ast.walk(node):
+            if (isinstance(sub, ast.Name) and isinstance(sub.ctx, ast.Store)
+                and sub.id in DECLARATIONS):
+                self.assigned[sub.id] = None
+
+    def get(self, name, default=None):
+        if name not in self.assigned:
+            return default
+        node = self.assigned[name]
+        if node is None:
+            raise NotStatic(name)
+        return self.value(node)
+
+    def _loaded_attr(self, mod_name, attr):
+        # constants (like the frequencies) of modules that are already
+        # loaded anyway, nothing is imported for them
+        mod = sys.modules.get(mod_name)
+        if mod is None or not hasattr(mod, attr):
+            raise NotStatic("%s.%s" % (mod_name, attr))
+        value = getattr(mod, attr)
+        if not isinstance(value, (basestring, int, long, float, bool)):
+            raise NotStatic("%s.%s" % (mod_name, attr))
+        return value
+
+    def value(self, node):
+        if isinstance(node, ast.Str):
+            return node.s
+        if isinstance(node, ast.Num):
+            return node.n
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [self.value(elt) for elt in node.elts]
+        if isinstance(node, ast.Name):
+            if node.id in ('None', 'True', 'False'):
+                return {'None': None, 'True': True, 'False': False}[node.id]
+            bound = self.names.get(node.id)
+            if bound and bound[0] == 'from':
+                return self._loaded_attr(bound[1], bound[2])
+        if isinstance(node, ast.Attribute) and isinstance(node.value,
+                                                          ast.Name):
+            bound = self.names.get(node.value.id)
+            if bound and bound[0] == 'module':
+                return self._loaded_attr(bound[1], node.attr)
+            if bound and bound[0] == 'from':
+                return self._loaded_attr("%s.%s" % (bound[1], bound[2]),
+                                         node.attr)
+        raise NotStatic(ast.dump(node))
+
+    def entry_point(self, node):
+        # the 'module:Class' of a class the module refers to
+        if isinstance(node, ast.Name):
+            bound = self.names.get(node.id)
+            if bound == ('class',):
+                return "%s:%s" % (self.mod_name, node.id)
+            if bound and bound[0] == 'from':
+                return "%s:%s" % (bound[1], bound[2])
+        if isinstance(node, ast.Attribute) and isinstance(node.value,
+                                                          ast.Name):
+            bound = self.names.get(node.value.id)
+            if bound and bound[0] == 'module':
+                return "%s:%s" % (bound[1], node.attr)
+            if bound and bound[0] == 'from':
+                return "%s.%s:%s" % (bound[1], bound[2], node.attr)
+        raise NotStatic(ast.dump(node))
+
+
+def _describe_handler(mod_name, decl):
+    depends = decl.get("depends", [])
+    return {
+        'module': mod_name,
+        'frequency': decl.get("frequency", settings.per_instance),
+        'depends': [normalize_name(d) for d in depends],
+        'resources': decl.get("resources", None),
+    }
+
+
+def _describe_source(mod_name, decl):
+    # sources that list their classes (and what those depend on) in
+    # 'datasources' are indexed, the others are asked (through their
+    # get_datasource_list) once imported
+    described = {
+        'module': mod_name,
+        'datasources': None,
+    }
+    node = decl.assigned.get("datasources")
+    if "datasources" not in decl.assigned:
+        return described
+    if not isinstance(node, (ast.List, ast.Tuple)):
+        raise NotStatic("datasources")
+    described['datasources'] = []
+    for elt in node.elts:
+        if not isinstance(elt, ast.Tuple) or len(elt.elts) != 2:
+            raise NotStatic("datasources")
+        described['datasources'].append([decl.entry_point(elt.elts[0]),
+                                         decl.value(elt.elts[1])])
+    return described
+
+
+class _Imported(object):
+    # the declarations of a module that was imported (as a last resort)
+
+    def __init__(self, mod):
+        self.mod = mod
+        self.assigned = {}
+        for name in DECLARATIONS:
+            if hasattr(mod, name):
+                self.assigned[name] = getattr(mod, name)
+
+    def get(self, name, default=None):
+        return self.assigned.get(name, default)
+
+
+def _describe_imported_source(mod_name, decl):
+    described = {
+        'module': mod_name,
+        'datasources': None,
+    }
+    datasources = decl.get("datasources")
+    if datasources is not None:
+        described['datasources'] = []
+        for (cls, deps) in datasources:
+            described['datasources'].append(
+                ["%s:%s" % (cls.__module__, cls.__name__), list(deps)])
+    return described
+
+
+def _describe(kind, mod_name):
+    # (description, source file) of a module
+    fn = find_source(mod_name)
+    if fn:
+        try:
+            decl = _Declarations(mod_name, fn)
+            if kind == 'handlers':
+                return (_describe_handler(mod_name, decl), fn)
+            return (_describe_source(mod_name, decl), fn)
+        except NotStatic as e:
+            log.debug("Importing %s to index it, %s is not static", mod_name,
+                      e)
+    else:
+        log.debug("Importing %s to index it, it has no source", mod_name)
+    mod = importer.import_module(mod_name)
+    decl = _Imported(mod)
+    if kind == 'handlers':
+        return (_describe_handler(mod_name, decl), fn)
+    return (_describe_imported_source(mod_name, decl), fn)
+
+
+def build():
+    """
+    Return an index of every handler & datasource module there is (along
+    with the files & directories it was built from), mostly without
+    importing them.
+    """
+    index = {
+        'handlers': {},
+        'sources': {},
+    }
+    ep_files = _entry_point_files()
+    inputs = list(ep_files)
+    kinds = [
+        ('handlers', settings.cc_mod_tpl, HANDLER_GROUP),
+        ('sources', settings.src_mod_tpl, SOURCE_GROUP),
+    ]
+    for (kind, mod_tpl, group) in kinds:
+        (path, found) = _package_modules(mod_tpl)
+        inputs.append(path)
+        # entry points of the same name replace the modules we ship
+        found.extend(_entry_points(group, ep_files))
+        for (name, mod_name) in found:
+            try:
+                (index[kind][name], fn) = _describe(kind, mod_name)
+            except Exception:
+                log.warn("Failed indexing %s %s (%s)", kind, name, mod_name,
+                         exc_info=True)
+                continue
+            if fn:
+                inputs.append(fn)
+    return (index, inputs)
+
+
+class Registry(object):
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.index = None
+        self.rebuilt = False
+        self._lock = threading.Lock()
+
+    def _key(self):
+        return [REGISTRY_VERSION, sys.path]
+
+    def _load(self):
+        if self.index is None:
+            self.index = cfg_cache.load(self.fn, self._key())
+        if self.index is None:
+            self._rebuild()
+        return self.index
+
+    def _rebuild(self):
+        (self.index, inputs) = build()
+        self.rebuilt = True
+        log.debug("Indexed %s handlers and %s datasources into %s",
+                  len(self.index['handlers']), len(self.index['sources']),
+                  self.fn)
+        cfg_cache.save(self.fn, self.index, inputs, self._key())
+
+    def _lookup(self, kind, name):
+        name = normalize_name(name)
+        with self._lock:
+            found = self._load()[kind].get(name)
+            if found is None and not self.rebuilt:
+                # maybe installed since the index was built
+                self._rebuild()
+                found = self.index[kind].get(name)
+        if found is None:
+            raise RuntimeError("No %s named %r is installed" %
+                               (kind[0:-1], name))
+        return found
+
+    def get_handler(self, name):
+        """
+        Returns the module, frequency, depends & resources of a handler.
+        """
+        return self._lookup('handlers', name)
+
+    def get_source(self, name):
+        """
+        Returns the module & datasources (as 'module:Class' entry points with
+        the dependencies of each) of a datasource module.
+        """
+        return self._lookup('sources', name)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = Registry(settings.registry_index)
+    return _registry
@@ -0,0 +1,352 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A resident condenser, which is forked off start at the end of its stage
+(listening on the UNIX socket that start bound for it) and runs the later
+stages when asked to, with what start loaded (its imports, datasource and
+config) kept around for them.
+
+Requests and replies are json lines, the client sends the stage to run:
+
+    {"action": "config", "verbosity": 1}
+
+and gets back that it was taken on, which it answers with that it is to
+be started (so that the stage is run by one of them only, a client that
+gave up waiting before that runs it itself), then gets what is logged
+while it runs and its return code:
+
+    {"accepted": "config"}
+                                   {"start": "config"}
+    {"log": "INFO: @condense : ..."}
+    {"rc": 0}
+"""
+
+import errno
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+
+from condense import log
+from condense import logging
+
+# How long a client has to send its request (and to start it)
+REQUEST_TIMEOUT = 10
+
+# How long a client waits for its stage to be taken on before running the
+# stage itself instead, and for the next reply while it runs before giving
+# up on it
+ACCEPT_TIMEOUT = 10
+REPLY_TIMEOUT = 600
+
+# How long to wait for the threads start left running (like probes & name
+# lookups that were given up on) to finish before forking
+QUIESCE_TIMEOUT = 2
+
+
+def _send(sock, obj):
+    sock.sendall(json.dumps(obj) + "\n")
+
+
+def _read_line(fh):
+    line = fh.readline()
+    if not line.endswith("\n"):
+        return None
+    return json.loads(line)
+
+
+class ClientLogHandler(logging.Handler):
+    """
+    Sends what is logged (while a stage runs) back to the client that
+    asked for it.
+    """
+
+    def __init__(self, sock):
+        logging.Handler.__init__(self)
+        self.sock = sock
+        self.broken = False
+
+    def emit(self, record):
+        if self.broken:
+            return
+        try:
+            _send(self.sock, {'log': self.format(record)})
+        except socket.error:
+            # it went away, keep on running the stage regardless
+            self.broken = True
+        except (TypeError, ValueError):
+            # (like bytes that are not utf-8)
+            self.handleError(record)
+
+
+class Server(object):
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.sock = None
+
+    @classmethod
+    def from_fd(cls, fd, fn):
+        """
+        A server listening on the (already bound) socket of the given file
+        descriptor.
+        """
+        server = cls(fn)
+        # (fromfd gives a bare _socket.socket, whose connections do not
+        # behave like those of a socket.socket)
+        server.sock = socket.socket(_sock=socket.fromfd(fd, socket.AF_UNIX,
+                                                        socket.SOCK_STREAM))
+        # (fails when it is not a socket)
+        server.sock.getsockname()
+        return server
+
+    def bind(self):
+        """
+        Start listening, returning False if another resident condenser is
+        already listening.
+        """
+        if is_listening(self.fn):
+            return False
+        try:
+            os.unlink(self.fn)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            old_umask = os.umask(0077)
+            try:
+                sock.bind(self.fn)
+            finally:
+                os.umask(old_umask)
+            sock.listen(1)
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+        return True
+
+    def serve(self, run_stage, idle_timeout=None, last_action=None):
+        """
+        Run the stages clients ask for (one at a time) by calling
+        run_stage(request), until the last stage was run or no client came
+        along for idle_timeout seconds.
+        """
+        while True:
+            self.sock.settimeout(idle_timeout)
+            try:
+                (conn, _addr) = self.sock.accept()
+            except socket.timeout:
+                log.info("No stage was asked for in %s seconds, stopping",
+                         idle_timeout)
+                return 0
+            try:
+                action = self._handle(conn, run_stage)
+            finally:
+                conn.close()
+            if action is not None and action == last_action:
+                return 0
+
+    def _handle(self, conn, run_stage):
+        conn.settimeout(REQUEST_TIMEOUT)
+        fh = conn.makefile("rb")
+        try:
+            request = _read_line(fh)
+        except (socket.error, ValueError):
+            log.warn("Failed reading a request", exc_info=True)
+            return None
+        if not isinstance(request, dict):
+            log.warn("Ignoring malformed request %r", request)
+            return None
+        try:
+            _send(conn, {'accepted': request.get('action')})
+            start = _read_line(fh)
+        except (socket.error, ValueError):
+            start = None
+        if not isinstance(start, dict) or 'start' not in start:
+            # it gave up waiting (and runs the stage itself)
+            log.warn("Not running %r, the client that asked for it went "
+                     "away", request.get('action'))
+            return None
+        conn.settimeout(None)
+        handler = ClientLogHandler(conn)
+        handler.setFormatter(logging.Formatter(logging.LOG_FORMAT))
+        log.addHandler(handler)
+        try:
+            try:
+                rc = run_stage(request)
+            except Exception:
+                log.exception("Running %r failed", request.get('action'))
+                rc = 1
+        finally:
+            log.removeHandler(handler)
+        try:
+            _send(conn, {'rc': rc})
+        except socket.error:
+            log.warn("Failed replying to %r", request.get('action'))
+        return request.get('action')
+
+    def close(self, unlink=True):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if unlink:
+            try:
+                os.unlink(self.fn)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def is_listening(fn):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(fn)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def quiesce(timeout=QUIESCE_TIMEOUT):
+    """
+    Wait up to timeout seconds for the threads besides the calling one to
+    finish, returning those still running (a fork only keeps the calling
+    thread, so whatever locks the others hold would stay held in it).
+    """
+    me = threading.current_thread()
+    deadline = time.time() + timeout
+    while True:
+        running = [t for t in threading.enumerate()
+                   if t is not me and t.is_alive()]
+        remaining = deadline - time.time()
+        if not running or remaining <= 0:
+            return running
+        running[0].join(remaining)
+
+
+def detach():
+    """
+    Fork, returning the pid of the child in the parent and 0 in the child,
+    which is moved into a session of its own (and away from the console).
+
+    Only to be done once quiesce() found no other threads running.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    os.setsid()
+    null_fd = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null_fd, fd)
+    if null_fd > 2:
+        os.close(null_fd)
+    return 0
+
+
+def spawn(server, args):
+    """
+    Start a resident condenser (running args) with the socket the server
+    listens on as its stdin, in a session of its own (and away from the
+    console), returning its pid.
+
+    It is a fresh process (which has to load everything again), for when
+    threads that are still running make forking one unsafe.
+    """
+    with open(os.devnull, "r+b") as null:
+        sp = subprocess.Popen(args, stdin=server.sock, stdout=null,
+                              stderr=null, close_fds=True,
+                              preexec_fn=os.setsid)
+    return sp.pid
+
+
+def request(fn, action, out, accept_timeout=ACCEPT_TIMEOUT,
+            reply_timeout=REPLY_TIMEOUT, **kwargs):
+    """
+    Ask a resident condenser to run a stage, writing what it logs to out,
+    and return its return code.
+
+    Returns None when the stage is to be run by the caller instead, which
+    is when there is none listening or it did not take the stage on within
+    accept_timeout seconds. Once it was started the stage is never run by
+    the caller too, when the resident condenser goes away or does not reply
+    for reply_timeout seconds while running it, it failed.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(accept_timeout)
+    try:
+        try:
+            sock.connect(fn)
+        except socket.timeout:
+            out.write("The resident condenser did not answer in %s seconds\n"
+                      % (accept_timeout))
+            return None
+        except socket.error as e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                return None
+            raise
+        req = dict(kwargs)
+        req['action'] = action
+        _send(sock, req)
+        fh = sock.makefile("rb")
+        accepted = False
+        while True:
+            try:
+                reply = _read_line(fh)
+            except socket.timeout:
+                if accepted:
+                    out.write("The resident condenser did not reply for %s "
+                              "seconds while running %r\n" % (reply_timeout,
+                                                              action))
+                    return 1
+                out.write("The resident condenser did not take on %r in %s "
+                          "seconds\n" % (action, accept_timeout))
+                return None
+            except (socket.error, ValueError):
+                reply = None
+            if reply is None:
+                if not accepted:
+                    out.write("The resident condenser went away before "
+                              "running %r\n" % (action))
+                    return None
+                out.write("The resident condenser went away while running "
+                          "%r\n" % (action))
+                return 1
+            if 'accepted' in reply and not accepted:
+                try:
+                    _send(sock, {'start': action})
+                except socket.error:
+                    # (and so it will not be run there)
+                    out.write("The resident condenser went away before "
+                              "running %r\n" % (action))
+                    return None
+                accepted = True
+                sock.settimeout(reply_timeout)
+                continue
+            if 'rc' in reply:
+                return reply['rc']
+            line = reply.get('log')
+            if isinstance(line, unicode):
+                # (json gives back unicode, out may only take ascii)
+                line = line.encode('utf-8')
+            out.write("%s\n" % (line))
+            out.flush()
+    finally:
+        sock.close()
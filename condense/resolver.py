@@ -0,0 +1,106 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import socket
+import threading
+import time
+
+import condense.log as logging
+
+log = logging.getLogger()
+
+# name => list of (family, socktype, proto, sockaddr) it resolved to
+# (an empty list if it did not resolve), kept for the process lifetime
+_cache = {}
+_lock = threading.Lock()
+
+
+def _getaddrinfo(name):
+    try:
+        infos = socket.getaddrinfo(name, None, 0, socket.SOCK_STREAM)
+    except socket.gaierror:
+        return []
+    addrs = []
+    for (family, socktype, proto, _canonname, sockaddr) in infos:
+        addr = (family, socktype, proto, sockaddr)
+        if addr not in addrs:
+            addrs.append(addr)
+    return addrs
+
+
+def lookup(name):
+    """
+    Returns the cached addresses of a name, None if it was not resolved.
+    """
+    with _lock:
+        return _cache.get(name)
+
+
+def resolve(names, timeout=None):
+    """
+    Resolve all of the given names concurrently, waiting at most timeout
+    seconds (in total) for them. Returns a dictionary of name => addresses
+    where names that did not resolve (in time) have an empty list.
+
+    Results are cached, except for names that timed out so that they can
+    be tried again later.
+    """
+    results = {}
+    pending = []
+    with _lock:
+        for name in names:
+            if not name:
+                results[name] = []
+            elif name in _cache:
+                results[name] = _cache[name]
+            elif name not in pending:
+                pending.append(name)
+    if not pending:
+        return results
+
+    def resolver(name):
+        addrs = _getaddrinfo(name)
+        with _lock:
+            _cache[name] = addrs
+
+    threads = []
+    for name in pending:
+        t = threading.Thread(target=resolver, args=(name,),
+                             name="resolve-%s" % (name))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    started = time.time()
+    for t in threads:
+        wait_for = None
+        if timeout is not None:
+            wait_for = max(0, (started + timeout) - time.time())
+        t.join(wait_for)
+
+    with _lock:
+        for name in pending:
+            if name in _cache:
+                results[name] = _cache[name]
+            else:
+                log.warn("Resolving %r did not finish within %s seconds",
+                         name, timeout)
+                results[name] = []
+    return results
+
+
+def is_resolvable(name, timeout=None):
+    return bool(resolve([name], timeout)[name])
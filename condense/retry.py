@@ -0,0 +1,102 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import random
+import time
+
+from condense import log
+from condense import util
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with (full) jitter, capped per attempt and bounded
+    by a global deadline.
+
+    The sleep before retry number N is picked uniformly from
+    [0, min(cap, base * factor ** N)] so that a whole rack of instances
+    that started at the same time does not retry in lockstep.
+    """
+
+    def __init__(self, base=1.0, factor=2.0, cap=10.0, deadline=None,
+                 jitter=True):
+        self.base = float(base)
+        self.factor = float(factor)
+        self.cap = float(cap)
+        self.deadline = deadline
+        self.jitter = jitter
+        self.started = None
+
+    @classmethod
+    def from_config(cls, cfg, deadline=None, prefix="backoff_"):
+        """
+        Build a policy from the '<prefix>base', '<prefix>factor',
+        '<prefix>cap' and '<prefix>jitter' keys of the given config.
+        """
+        if not hasattr(cfg, "get"):
+            cfg = {}
+        defaults = cls()
+        kwargs = {}
+        for name in ('base', 'factor', 'cap'):
+            default = getattr(defaults, name)
+            try:
+                kwargs[name] = float(cfg.get(prefix + name, default))
+            except Exception:
+                util.logexc(log)
+                log.warn("Failed to get %s%s, using %s" %
+                         (prefix, name, default))
+                kwargs[name] = default
+        kwargs['jitter'] = util.get_cfg_option_bool(cfg, prefix + "jitter",
+                                                    defaults.jitter)
+        return cls(deadline=deadline, **kwargs)
+
+    def start(self):
+        self.started = time.time()
+        return self
+
+    def time_left(self):
+        """
+        Seconds left before the deadline (None if there is no deadline).
+        """
+        if self.deadline is None:
+            return None
+        if self.started is None:
+            self.start()
+        return max(0.0, (self.started + self.deadline) - time.time())
+
+    def expired(self):
+        left = self.time_left()
+        return left is not None and left <= 0
+
+    def next_sleep(self, attempt):
+        """
+        How long to sleep before the given (0 based) retry attempt, never
+        sleeping past the deadline. Returns None once the deadline passed.
+        """
+        if self.expired():
+            return None
+        try:
+            ceiling = min(self.cap, self.base * (self.factor ** attempt))
+        except OverflowError:
+            ceiling = self.cap
+        if self.jitter:
+            sleeptime = random.uniform(0, ceiling)
+        else:
+            sleeptime = ceiling
+        left = self.time_left()
+        if left is not None:
+            sleeptime = min(sleeptime, left)
+        return sleeptime
@@ -0,0 +1,218 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+import condense.log as logging
+
+log = logging.getLogger()
+
+# The first entry of every journal (so that an empty journal can be told
+# apart from one whose semaphores were all cleared)
+INIT_OP = 'init'
+ACQUIRE_OP = 'acquire'
+CLEAR_OP = 'clear'
+
+
+def _locked(func):
+    # run with the thread lock & the (exclusive) file lock held, after
+    # catching up on what other processes appended to the journal
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            self._lock_file()
+            try:
+                self._catch_up()
+                return func(self, *args, **kwargs)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+class SemaphoreDB(object):
+    """
+    Semaphores kept in a single journal file. Each acquire or clear is
+    appended to it (as a json line) while holding an exclusive fcntl lock on
+    it, after catching up on what other processes appended, so checking and
+    setting a semaphore is atomic across processes (and threads).
+
+    The entries are not batched, each is written (a single small append)
+    before acquire or clear returns, as other processes have to see it as
+    soon as the lock is let go. What is left for flush (meant to be called
+    once at the end of a stage) is syncing the journal to disk and
+    compacting it (into one entry per semaphore held).
+    """
+
+    def __init__(self, fn, legacy=None):
+        self.fn = fn
+        # callable returning key => (time, pid) of the semaphores that were
+        # kept the old way (a file each), imported into a new journal
+        self.legacy = legacy
+        self.held = {}
+        self._fd = None
+        self._offset = 0
+        self._entries = 0
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        self.held = {}
+        self._offset = 0
+        self._entries = 0
+
+    def _lock_file(self):
+        while True:
+            if self._fd is None:
+                try:
+                    os.makedirs(os.path.dirname(self.fn))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                self._fd = os.open(self.fn,
+                                   os.O_RDWR | os.O_APPEND | os.O_CREAT, 0600)
+                self._reset()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                ino = os.stat(self.fn).st_ino
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                ino = None
+            if ino == os.fstat(self._fd).st_ino:
+                return
+            # it was replaced (compacted) by someone else, start over
+            os.close(self._fd)
+            self._fd = None
+
+    def _catch_up(self):
+        os.lseek(self._fd, self._offset, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self._fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = "".join(chunks)
+        end = data.rfind("\n") + 1
+        for line in data[0:end].splitlines():
+            try:
+                (op, key, when, pid) = json.loads(line)
+            except ValueError:
+                log.warn("Skipping corrupt semaphore entry %r in %s", line,
+                         self.fn)
+                continue
+            self._apply(op, key, when, pid)
+        self._offset += end
+        if end < len(data):
+            # entries are written whole while holding the lock, so this is
+            # what was left of a write that crashed, end it so that it gets
+            # skipped (instead of garbling the next entry)
+            os.write(self._fd, "\n")
+            self._offset += len(data) - end + 1
+        if self._offset == 0:
+            self._start()
+
+    def _start(self):
+        imported = {}
+        if self.legacy:
+            try:
+                imported = self.legacy()
+            except Exception:
+                log.warn("Failed importing the old semaphore files into %s",
+                         self.fn, exc_info=True)
+        self._append(INIT_OP, None)
+        for (key, (when, pid)) in sorted(imported.items()):
+            self._append(ACQUIRE_OP, key, when, pid)
+        if imported:
+            log.debug("Imported %s old semaphore files into %s",
+                      len(imported), self.fn)
+
+    def _apply(self, op, key, when, pid):
+        if op == ACQUIRE_OP:
+            self.held[key] = (when, pid)
+        elif op == CLEAR_OP:
+            self.held.pop(key, None)
+        if op != INIT_OP:
+            self._entries += 1
+
+    def _append(self, op, key, when=None, pid=None):
+        # caught up (and locked) an O_APPEND write lands at our offset
+        line = json.dumps([op, key, when, pid]) + "\n"
+        os.write(self._fd, line)
+        self._offset += len(line)
+        self._apply(op, key, when, pid)
+
+    @_locked
+    def has(self, key):
+        return key in self.held
+
+    @_locked
+    def acquire(self, key):
+        """
+        Atomically acquire a semaphore, returning False if it was already
+        held (by this or any other process).
+        """
+        if key in self.held:
+            return False
+        self._append(ACQUIRE_OP, key, time.time(), os.getpid())
+        return True
+
+    @_locked
+    def clear(self, key):
+        if key in self.held:
+            self._append(CLEAR_OP, key)
+        return True
+
+    @_locked
+    def flush(self):
+        """
+        Sync the journal to disk, replacing it with a compacted copy when
+        it has more entries than semaphores held.
+        """
+        if self._entries <= len(self.held):
+            os.fsync(self._fd)
+            return False
+        lines = [json.dumps([INIT_OP, None, None, None])]
+        for (key, (when, pid)) in sorted(self.held.items()):
+            lines.append(json.dumps([ACQUIRE_OP, key, when, pid]))
+        (fd, tmp_fn) = tempfile.mkstemp(prefix=os.path.basename(self.fn),
+                                        dir=os.path.dirname(self.fn))
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write("\n".join(lines) + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.rename(tmp_fn, self.fn)
+        except:
+            os.unlink(tmp_fn)
+            raise
+        log.debug("Compacted the %s entries of %s into %s", self._entries,
+                  self.fn, len(self.held))
+        # we hold the lock on the replaced file, the next operation opens
+        # (and reads) the compacted one
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
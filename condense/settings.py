@@ -11,12 +11,27 @@ varlibdir = os.path.join('/var/lib/', root_name)
 cur_instance_link = os.path.join(varlibdir, "instance")
 boot_finished = os.path.join(cur_instance_link, "boot-finished")
 
+# Where a resident condenser listens for the stages to run
+resident_socket = os.path.join('/var/run/', root_name + '.sock')
+
+# Where the last metadata service endpoint that worked is remembered
+last_endpoint_file = os.path.join(varlibdir, "data", "metadata-endpoint")
+
+# Where parsed config files are kept in a faster to load form
+parse_cache_dir = os.path.join(varlibdir, "data", "parse-cache")
+
+# Where templates are kept once compiled
+template_cache_dir = os.path.join(varlibdir, "data", "template-cache")
+
+# Where the index of the handlers & datasources there are is kept
+registry_index = os.path.join(varlibdir, "data", "registry.marshal")
+
 # Where our root config should be
 system_config = os.path.join('/etc/', root_name, root_name + '.cfg')
 
 # Backup when cfg can't be loaded
 cfg_builtin = {
-    'datasource_list': ["ec2"],
+    'datasource_list': ["seed", "ec2"],
 }
 
 # TBD
@@ -24,11 +39,16 @@ pathmap = {
    "handlers": "/handlers",
    "scripts": "/scripts",
    "sem": "/sem",
+   "sem_db": "/data/semaphores.db",
    "boothooks": "/boothooks",
    "userdata_raw": "/user-data.txt",
    "userdata": "/user-data.txt.i",
+   "userdata_hash": "/user-data.sha1",
    "obj_pkl": "/obj.pkl",
+   "obj_cache": "/obj.cache",
    "cloud_config": "/cloud-config.txt",
+   "cloud_config_compiled": "/cloud-config.marshal",
+   "base_config_compiled": "/data/base-config.marshal",
    "data": "/data",
    None: "",
 }
@@ -18,16 +18,31 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from condense import crawler
 from condense import data_source
+from condense import http_client
 from condense import log
+from condense import retry
+from condense import settings
 from condense import util
 
-import os
+import errno
+import json
+import Queue
 import socket
+import threading
 import time
-import urllib2
 
-import boto.utils as boto_utils
+
+# The shape (is it a directory?) of the keys the handlers look at, so that
+# they can be loaded without first listing the whole metadata tree.
+KNOWN_KEYS = {
+    'instance-id': False,
+    'hostname': False,
+    'local-hostname': False,
+    'block-device-mapping': True,
+    'placement': True,
+}
 
 
 class DataSourceEc2(data_source.DataSource):
@@ -41,17 +56,128 @@ class DataSourceEc2(data_source.DataSource):
         try:
             if not self.wait_for_metadata_service():
                 return False
-            start = time.time()
-            log.info("Calling into metadata service using boto at: %s", self.metadata_address)
-            self.userdata_raw = boto_utils.get_instance_userdata(self.api_ver,  None, self.metadata_address)
-            self.metadata = boto_utils.get_instance_metadata(self.api_ver, self.metadata_address)
-            log.debug("Crawl of metadata service took %s seconds" % (time.time() - start))
-            log.debug("Received raw userdata: %s", self.userdata_raw)
-            log.debug("Received metadata: %s", self.metadata)
-            return True
+            return self.get_ec2_data()
         except Exception:
+            util.logexc(log)
             return False
 
+    def get_ec2_data(self):
+        start = time.time()
+        log.info("Calling into metadata service at: %s", self.metadata_address)
+        md_crawler = self._get_crawler()
+        self.userdata_raw = md_crawler.fetch("user-data", allow_404=True)
+        if util.get_cfg_option_bool(self.ds_cfg, "lazy_metadata", True):
+            # Only fetch what is really used, when it is first used.
+            self.metadata = data_source.LazyMetadata(self._get_loader(),
+                                                     known=KNOWN_KEYS)
+        else:
+            self.metadata = md_crawler.crawl("meta-data/")
+        log.debug("Crawl of metadata service took %s seconds" % (time.time() - start))
+        log.debug("Received raw userdata: %s", self.userdata_raw)
+        log.debug("Received metadata: %s", self.metadata)
+        return True
+
+    def get_current_instance_id(self, timeout=None):
+        # a single request to the service the metadata came from
+        url = "%s/%s/meta-data/instance-id" % (self.metadata_address,
+                                               self.api_ver)
+        try:
+            return http_client.request(url, timeout=timeout).contents.strip()
+        except Exception as e:
+            log.info("Fetching the current instance-id from %s failed: %s",
+                     url, e)
+            return None
+
+    def get_cache_state(self):
+        lazy = isinstance(self.metadata, data_source.LazyMetadata)
+        return {
+            'metadata_address': self.metadata_address,
+            'lazy_metadata': lazy,
+        }
+
+    def restore_cache_state(self, state):
+        self.metadata_address = state.get('metadata_address',
+                                          self.metadata_address)
+        if state.get('lazy_metadata') and self.metadata is not None:
+            # keep loading what was not fetched yet
+            self.metadata = data_source.LazyMetadata(self._get_loader(),
+                                                     fetched=self.metadata,
+                                                     known=KNOWN_KEYS)
+
+    def _get_cfg_int(self, key, default):
+        mcfg = self.ds_cfg
+        if not hasattr(mcfg, "get"):
+            mcfg = {}
+        try:
+            return int(mcfg.get(key, default))
+        except Exception:
+            util.logexc(log)
+            log.warn("Failed to get %s, using %s" % (key, default))
+            return default
+
+    def _get_crawler(self):
+        base_url = "%s/%s/" % (self.metadata_address, self.api_ver)
+        return crawler.MetadataCrawler(base_url,
+            max_connections=self._get_cfg_int("crawl_connections", 4),
+            timeout=self._get_cfg_int("crawl_timeout", 10),
+            deadline=self._get_cfg_int("crawl_deadline", 60))
+
+    def _get_loader(self):
+        base_url = "%s/%s/" % (self.metadata_address, self.api_ver)
+        return crawler.MetadataLoader(base_url,
+            max_connections=self._get_cfg_int("crawl_connections", 4),
+            timeout=self._get_cfg_int("crawl_timeout", 10),
+            deadline=self._get_cfg_int("crawl_deadline", 60))
+
+    def _try_known_endpoint(self, mdurls, timeout):
+        try:
+            with open(settings.last_endpoint_file, "rb") as fh:
+                known = json.loads(fh.read())
+            base = known['url']
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                util.logexc(log)
+            return None
+        except Exception:
+            log.warn("Ignoring bad last known metadata endpoint file: %s",
+                     settings.last_endpoint_file)
+            util.logexc(log)
+            return None
+
+        if base not in mdurls:
+            log.debug("Last known metadata source %s is no longer one of "
+                      "%s", base, mdurls)
+            return None
+
+        if not util.is_resolvable_url(base, timeout):
+            log.info("Last known metadata source %s is not resolvable", base)
+            return None
+
+        url = "%s/%s/meta-data/instance-id" % (base, self.api_ver)
+        log.debug("Trying last known metadata source %s (took %s seconds "
+                  "last time) [timeout=%s]", base, known.get('latency'),
+                  timeout)
+        start = time.time()
+        (url, reason) = _probe_url(url, timeout)
+        if reason is not None:
+            log.info("Last known metadata source %s failed due to %r", base,
+                     reason)
+            return None
+        self._remember_endpoint(base, time.time() - start)
+        return base
+
+    def _remember_endpoint(self, base, latency):
+        if not base:
+            return
+        contents = json.dumps({'url': base, 'latency': round(latency, 4)})
+        try:
+            util.write_file(settings.last_endpoint_file, contents + "\n",
+                            0644)
+        except (IOError, OSError):
+            log.warn("Failed to remember the metadata endpoint in %s",
+                     settings.last_endpoint_file)
+            util.logexc(log)
+
     def get_instance_id(self):
         return self.metadata['instance-id']
 
@@ -84,8 +210,19 @@ class DataSourceEc2(data_source.DataSource):
         def_mdurls = ["http://169.254.169.254", "http://instance-data:8773"]
         mdurls = mcfg.get("metadata_urls", def_mdurls)
 
-        # Remove addresses from the list that wont resolve.
-        filtered = [x for x in mdurls if util.is_resolvable_url(x)]
+        # Try whatever worked last time first (and quickly) before
+        # going through the whole discovery of all of the urls.
+        known_timeout = self._get_cfg_int("known_endpoint_timeout", 2)
+        known = self._try_known_endpoint(mdurls, known_timeout)
+        if known:
+            log.info("Using last known metadata source: '%s'" % known)
+            self.metadata_address = known
+            return True
+
+        # Remove addresses from the list that wont resolve (resolving them
+        # all at once, the http requests reuse what they resolved to).
+        resolve_timeout = self._get_cfg_int("resolve_timeout", 5)
+        filtered = util.filter_resolvable_urls(mdurls, resolve_timeout)
 
         if set(filtered) != set(mdurls):
             log.debug("Removed the following unresolveable addrs from metadata urls: %s" %
@@ -108,8 +245,13 @@ class DataSourceEc2(data_source.DataSource):
         def status_cb(url, why, details):
             log.warn("Calling %r failed due to %r: %s", url, why, details)
 
+        def found_cb(url, latency):
+            self._remember_endpoint(url2base.get(url), latency)
+
+        policy = retry.RetryPolicy.from_config(mcfg, deadline=max_wait)
         url = wait_for_metadata_service(urls=urls, max_wait=max_wait,
-                  timeout=timeout, status_cb=status_cb)
+                  timeout=timeout, status_cb=status_cb, retry_policy=policy,
+                  found_cb=found_cb)
 
         if url:
             log.info("Using metadata source: '%s'" % url2base.get(url))
@@ -120,68 +262,22 @@ class DataSourceEc2(data_source.DataSource):
         self.metadata_address = url2base.get(url) or False
         return bool(url)
 
-    def device_name_to_device(self, name):
-        # consult metadata service, that has
-        #  ephemeral0: sdb
-        # and return 'sdb' for input 'ephemeral0'
-        if 'block-device-mapping' not in self.metadata:
-            return None
-
-        found = None
-        for entname, device in self.metadata['block-device-mapping'].items():
-            if entname == name:
-                found = device
-                break
-            # LP: #513842 mapping in Euca has 'ephemeral' not 'ephemeral0'
-            if entname == "ephemeral" and name == "ephemeral0":
-                found = device
-        if found == None:
-            log.debug("unable to convert %s to a device" % name)
-            return None
-
-        # LP: #611137
-        # the metadata service may believe that devices are named 'sda'
-        # when the kernel named them 'vda' or 'xvda'
-        # we want to return the correct value for what will actually
-        # exist in this instance
-        mappings = {"sd": ("vd", "xvd")}
-        ofound = found
-        short = os.path.basename(found)
-
-        if not found.startswith("/"):
-            found = "/dev/%s" % found
-
-        if os.path.exists(found):
-            return found
-
-        for nfrom, tlist in mappings.items():
-            if not short.startswith(nfrom):
-                continue
-            for nto in tlist:
-                cand = "/dev/%s%s" % (nto, short[len(nfrom):])
-                if os.path.exists(cand):
-                    log.debug("remapped device name %s => %s" % (found, cand))
-                    return cand
-
-        # on t1.micro, ephemeral0 will appear in block-device-mapping from
-        # metadata, but it will not exist on disk (and never will)
-        # at this pint, we've verified that the path did not exist
-        # in the special case of 'ephemeral0' return None to avoid bogus
-        # fstab entry (LP: #744019)
-        if name == "ephemeral0":
-            return None
-        return ofound
-
 
 def wait_for_metadata_service(urls, max_wait=None, timeout=None,
-                              status_cb=None):
+                              status_cb=None, retry_policy=None,
+                              found_cb=None):
     """
     urls:      a list of urls to try
     max_wait:  roughly the maximum time to wait before giving up
-               The max time is *actually* len(urls)*timeout as each url will
-               be tried once and given the timeout provided.
-    timeout:   the timeout provided to urllib2.urlopen
+               All urls are probed concurrently on each attempt, so the
+               max time is *actually* max_wait + timeout at worst.
+    timeout:   the timeout provided to each http request
     status_cb: call method with string message when a url is not available
+    retry_policy: the RetryPolicy deciding how long to sleep between
+               attempts, by default exponential backoff with jitter
+               bounded by max_wait
+    found_cb:  call method with the url that answered and how long
+               (in seconds) it took to answer
 
     the idea of this routine is to wait for the EC2 metdata service to
     come up.  On both Eucalyptus and EC2 we have seen the case where
@@ -198,9 +294,14 @@ def wait_for_metadata_service(urls, max_wait=None, timeout=None,
     data host (169.254.169.254) may be firewalled off Entirely for a sytem,
     meaning that the connection will block forever unless a timeout is set.
     """
-    starttime = time.time()
-
-    sleeptime = 1
+    if max_wait is None or max_wait <= 0:
+        # only try once
+        max_wait = 0
+    if retry_policy is None:
+        retry_policy = retry.RetryPolicy(deadline=max_wait)
+    retry_policy.deadline = max_wait
+    retry_policy.start()
+    starttime = retry_policy.started
 
     def nullstatus_cb(url, why, details):
         return
@@ -208,54 +309,124 @@ def wait_for_metadata_service(urls, max_wait=None, timeout=None,
     if not status_cb:
         status_cb = nullstatus_cb
 
-    def timeup(max_wait, starttime):
-        return((max_wait <= 0 or max_wait == None) or
-               (time.time() - starttime > max_wait))
-
     log.info("Waiting for meta service at urls %s [maxwait=%s, timeout=%s]", urls, max_wait, timeout)
-    loop_n = 0
+    attempt = 0
     while True:
-        sleeptime = int(loop_n / 5) + 1
-        for url in urls:
-            now = time.time()
-            if loop_n != 0:
-                if timeup(max_wait, starttime):
-                    break
-                if timeout and (now + timeout > (starttime + max_wait)):
-                    # shorten timeout to not run way over max_time
-                    timeout = int((starttime + max_wait) - now)
-
-            reason = ""
-            try:
-                req = urllib2.Request(url)
-                resp = urllib2.urlopen(req, timeout=timeout)
-                if resp.read() != "":
-                    return url
-                reason = "empty data [%s]" % resp.getcode()
-            except urllib2.HTTPError as e:
-                reason = "http error [%s]" % e.code
-            except urllib2.URLError as e:
-                reason = "url error [%s]" % e.reason
-            except socket.timeout as e:
-                reason = "socket timeout [%s]" % e
-            except Exception as e:
-                reason = "unexpected error [%s]" % e
+        if attempt != 0:
+            if retry_policy.expired():
+                break
+            left = retry_policy.time_left()
+            if timeout and timeout > left:
+                # shorten timeout to not run way over max_time
+                timeout = max(1, int(left))
 
-            details = "[%s/%ss]" % (int(time.time() - starttime), max_wait)
-            status_cb(url, reason, details)
+        (url, latency) = _probe_urls(urls, timeout, starttime, max_wait,
+                                     status_cb)
+        if url:
+            if found_cb:
+                found_cb(url, latency)
+            return url
 
-        if timeup(max_wait, starttime):
+        sleeptime = retry_policy.next_sleep(attempt)
+        if sleeptime is None:
             break
 
-        loop_n = loop_n + 1
+        attempt = attempt + 1
+        log.debug("Sleeping %.2f seconds before metadata attempt %s",
+                  sleeptime, attempt + 1)
         time.sleep(sleeptime)
 
     return False
 
 
+def _probe_url(url, timeout):
+    """
+    Fetch a single metadata url, returning (url, reason) where
+    reason is None when the url answered with non-empty data.
+    """
+    try:
+        resp = http_client.request(url, timeout=timeout)
+        if resp.contents != "":
+            return (url, None)
+        return (url, "empty data [%s]" % resp.code)
+    except http_client.HttpError as e:
+        return (url, "http error [%s]" % e.code)
+    except socket.timeout as e:
+        return (url, "socket timeout [%s]" % e)
+    except socket.error as e:
+        return (url, "socket error [%s]" % e)
+    except Exception as e:
+        return (url, "unexpected error [%s]" % e)
+
+
+def _probe_urls(urls, timeout, starttime, max_wait, status_cb):
+    """
+    Race all of the given urls against each other, returning the first
+    url that answers with non-empty data (or None if none of them do)
+    along with how long it took to answer.
+
+    Each url is probed in its own (daemon) thread so that a firewalled
+    address can not hold up the others. Once a winner is found the
+    remaining probes are abandoned, their results are ignored and their
+    threads die off on their own when their timeout expires.
+    """
+    results = Queue.Queue()
+    cancelled = threading.Event()
+
+    def prober(url):
+        started = time.time()
+        (url, reason) = _probe_url(url, timeout)
+        if not cancelled.is_set():
+            results.put((url, reason, time.time() - started))
+
+    for url in urls:
+        t = threading.Thread(target=prober, args=(url,),
+                             name="probe-%s" % (url))
+        t.daemon = True
+        t.start()
+
+    # Never wait longer than the probe timeout (the probes will have given
+    # up by then) and never run way over the max wait time either.
+    deadline = None
+    if timeout:
+        deadline = time.time() + timeout
+    if max_wait and max_wait > 0:
+        if deadline is None:
+            deadline = starttime + max_wait
+        else:
+            deadline = min(deadline, starttime + max_wait)
+
+    try:
+        pending = len(urls)
+        while pending:
+            wait_for = None
+            if deadline is not None:
+                # always give the probes a chance to report in
+                wait_for = max(0.1, deadline - time.time())
+            try:
+                (url, reason, latency) = results.get(timeout=wait_for)
+            except Queue.Empty:
+                log.debug("Abandoning %s unanswered metadata probes", pending)
+                break
+            pending -= 1
+            if reason is None:
+                if pending:
+                    log.debug("Abandoning %s slower metadata probes", pending)
+                return (url, latency)
+            details = "[%s/%ss]" % (int(time.time() - starttime), max_wait)
+            status_cb(url, reason, details)
+    finally:
+        cancelled.set()
+
+    return (None, None)
+
+
+# the data sources (and what each depends on) of this module
+datasources = [
+    (DataSourceEc2, (data_source.DEP_FILESYSTEM, data_source.DEP_NETWORK)),
+]
+
+
 # return a list of data sources that match this set of dependencies
 def get_datasource_list(depends):
-    sources = [
-        (DataSourceEc2, (data_source.DEP_FILESYSTEM, data_source.DEP_NETWORK)),
-    ]
-    return data_source.list_from_depends(depends, sources)
+    return data_source.list_from_depends(depends, datasources)
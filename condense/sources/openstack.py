@@ -0,0 +1,163 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from condense import data_source
+from condense import http_client
+from condense import log
+from condense import util
+
+from condense.sources import ec2
+
+import json
+import time
+
+
+def translate_metadata(os_md):
+    """
+    Map openstack's meta_data.json onto the (ec2 style) keys that the
+    datasources and handlers expect.
+    """
+    metadata = {}
+    if 'uuid' in os_md:
+        metadata['instance-id'] = os_md['uuid']
+    if 'hostname' in os_md:
+        metadata['hostname'] = os_md['hostname']
+        metadata['local-hostname'] = os_md['hostname']
+    if 'availability_zone' in os_md:
+        metadata['placement'] = {
+            'availability-zone': os_md['availability_zone'],
+        }
+    if 'launch_index' in os_md:
+        metadata['ami-launch-index'] = str(os_md['launch_index'])
+    if os_md.get('public_keys'):
+        metadata['public-keys'] = dict(os_md['public_keys'])
+    if os_md.get('meta'):
+        metadata['meta'] = dict(os_md['meta'])
+    return metadata
+
+
+class DataSourceOpenStack(ec2.DataSourceEc2):
+    """
+    Fetches the whole of openstack's meta_data.json and user_data documents
+    (two requests) instead of a request per metadata key, falling back to
+    the ec2 metadata when the openstack documents are not there.
+
+    Keys that the json document does not have (the block-device-mapping)
+    are still lazily loaded from the ec2 metadata when first used.
+
+    The instance-id is the uuid of the json document, or the ec2 i-... one
+    when falling back, which of the two is kept (as id_source) so that
+    revalidating the cache compares it to the same kind of id.
+    """
+    os_version = 'latest'
+    id_source = 'openstack'
+
+    def __str__(self):
+        return "DataSourceOpenStack"
+
+    def get_data(self):
+        try:
+            if not self.wait_for_metadata_service():
+                return False
+        except Exception:
+            util.logexc(log)
+            return False
+        try:
+            if self.get_openstack_data():
+                self.id_source = 'openstack'
+                return True
+        except Exception:
+            util.logexc(log)
+        log.info("Falling back to the ec2 metadata at: %s",
+                 self.metadata_address)
+        try:
+            self.id_source = 'ec2'
+            return self.get_ec2_data()
+        except Exception:
+            util.logexc(log)
+            return False
+
+    def _get_document(self, name, timeout):
+        mcfg = self.ds_cfg
+        if not hasattr(mcfg, "get"):
+            mcfg = {}
+        version = mcfg.get("openstack_version", self.os_version)
+        url = "%s/openstack/%s/%s" % (self.metadata_address, version, name)
+        try:
+            return http_client.request(url, timeout=timeout).contents
+        except http_client.HttpError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def get_cache_state(self):
+        state = ec2.DataSourceEc2.get_cache_state(self)
+        state['id_source'] = self.id_source
+        return state
+
+    def restore_cache_state(self, state):
+        ec2.DataSourceEc2.restore_cache_state(self, state)
+        self.id_source = state.get('id_source', self.id_source)
+
+    def get_current_instance_id(self, timeout=None):
+        if self.id_source == 'ec2':
+            return ec2.DataSourceEc2.get_current_instance_id(self, timeout)
+        # the cached instance-id is the uuid of meta_data.json (not the ec2
+        # i-... one), so ask for that (in a single request)
+        try:
+            os_md = self._get_document("meta_data.json", timeout)
+            if os_md is None:
+                return None
+            return json.loads(os_md).get('uuid')
+        except Exception as e:
+            log.info("Fetching the current instance uuid from %s failed: %s",
+                     self.metadata_address, e)
+            return None
+
+    def get_openstack_data(self):
+        start = time.time()
+        timeout = self._get_cfg_int("crawl_timeout", 10)
+        log.info("Calling into openstack metadata service at: %s",
+                 self.metadata_address)
+        os_md = self._get_document("meta_data.json", timeout)
+        if os_md is None:
+            log.debug("No openstack metadata found at: %s",
+                      self.metadata_address)
+            return False
+        os_md = json.loads(os_md)
+        if not isinstance(os_md, dict):
+            raise ValueError("Openstack metadata is not a dictionary")
+        self.userdata_raw = self._get_document("user_data", timeout) or ''
+        self.metadata = data_source.LazyMetadata(self._get_loader(),
+                            fetched=translate_metadata(os_md),
+                            known=ec2.KNOWN_KEYS)
+        log.debug("Fetching openstack metadata took %s seconds",
+                  (time.time() - start))
+        log.debug("Received raw userdata: %s", self.userdata_raw)
+        log.debug("Received metadata: %s", self.metadata)
+        return True
+
+
+# the data sources (and what each depends on) of this module
+datasources = [
+    (DataSourceOpenStack, (data_source.DEP_FILESYSTEM,
+                           data_source.DEP_NETWORK)),
+]
+
+
+# return a list of data sources that match this set of dependencies
+def get_datasource_list(depends):
+    return data_source.list_from_depends(depends, datasources)
@@ -0,0 +1,190 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from condense import data_source
+from condense import log
+from condense import settings
+from condense import util
+
+from condense.sources import openstack
+
+import errno
+import json
+import os
+
+# Where a seed (a 'meta-data' yaml file and a 'user-data' file) can be placed
+DEF_SEED_DIRS = [
+    os.path.join(settings.varlibdir, 'seed', 'local'),
+]
+
+# The filesystem labels a config-drive may have
+DEF_CONFIG_DRIVE_LABELS = [
+    'config-2',
+]
+
+
+def read_file(fn, default=None):
+    try:
+        with open(fn, "rb") as fh:
+            return fh.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT and default is not None:
+            return default
+        raise
+
+
+def read_seed_dir(seed_dir):
+    """
+    Read a seed directory, returning (metadata, userdata_raw) or None if
+    there is no seed in it.
+    """
+    md_fn = os.path.join(seed_dir, 'meta-data')
+    if not os.path.isfile(md_fn):
+        return None
+    metadata = util.read_conf(md_fn)
+    if not isinstance(metadata, dict):
+        raise ValueError("Seed meta-data %s is not a dictionary" % md_fn)
+    userdata_raw = read_file(os.path.join(seed_dir, 'user-data'), '')
+    return (metadata, userdata_raw)
+
+
+def read_config_drive_dir(drive_dir):
+    """
+    Read a mounted config-drive, returning (metadata, userdata_raw) or None
+    if it does not look like a config-drive. The ec2 formatted metadata is
+    preferred (it has the block-device-mapping) when it is there.
+    """
+    ec2_md_fn = os.path.join(drive_dir, 'ec2', 'latest', 'meta-data.json')
+    os_md_fn = os.path.join(drive_dir, 'openstack', 'latest',
+                            'meta_data.json')
+    if os.path.isfile(ec2_md_fn):
+        metadata = json.loads(read_file(ec2_md_fn))
+        if os.path.isfile(os_md_fn):
+            os_md = json.loads(read_file(os_md_fn))
+            os_md = openstack.translate_metadata(os_md)
+            metadata = util.mergedict(metadata, os_md)
+    elif os.path.isfile(os_md_fn):
+        os_md = json.loads(read_file(os_md_fn))
+        metadata = openstack.translate_metadata(os_md)
+    else:
+        return None
+    userdata_raw = read_file(os.path.join(drive_dir, 'openstack', 'latest',
+                                          'user_data'), '')
+    if not userdata_raw:
+        userdata_raw = read_file(os.path.join(drive_dir, 'ec2', 'latest',
+                                              'user-data'), '')
+    return (metadata, userdata_raw)
+
+
+def find_config_drive_mounts(labels, mounts_fn="/proc/mounts"):
+    """
+    Find where the devices with the given filesystem labels are mounted.
+    """
+    devices = set()
+    for label in labels:
+        by_label = os.path.join('/dev/disk/by-label', label)
+        if os.path.exists(by_label):
+            devices.add(os.path.realpath(by_label))
+    if not devices:
+        return []
+    found = []
+    try:
+        with open(mounts_fn, "r") as fh:
+            for line in fh.read().splitlines():
+                toks = line.split()
+                if len(toks) < 2 or not toks[0].startswith("/"):
+                    continue
+                if os.path.realpath(toks[0]) in devices:
+                    # spaces in mount points are octal escaped
+                    found.append(toks[1].decode('string_escape'))
+    except IOError:
+        util.logexc(log)
+    return found
+
+
+class DataSourceSeed(data_source.DataSource):
+    seed = None
+
+    def __str__(self):
+        return "DataSourceSeed [seed=%s]" % (self.seed)
+
+    def get_cache_state(self):
+        return {'seed': self.seed}
+
+    def restore_cache_state(self, state):
+        self.seed = state.get('seed')
+
+    def _get_cfg_list(self, key, default):
+        mcfg = self.ds_cfg
+        if not hasattr(mcfg, "get"):
+            mcfg = {}
+        return util.get_cfg_option_list_or_str(mcfg, key, default)
+
+    def _find_seed(self):
+        # (where, metadata, userdata_raw) of the first seed found, or None
+        candidates = []
+        for seed_dir in self._get_cfg_list("seed_dirs", DEF_SEED_DIRS):
+            candidates.append((read_seed_dir, seed_dir))
+        drive_dirs = list(self._get_cfg_list("config_drive_dirs", []))
+        labels = self._get_cfg_list("config_drive_labels",
+                                    DEF_CONFIG_DRIVE_LABELS)
+        drive_dirs.extend(find_config_drive_mounts(labels))
+        for drive_dir in drive_dirs:
+            candidates.append((read_config_drive_dir, drive_dir))
+
+        for (reader, where) in candidates:
+            if not os.path.isdir(where):
+                continue
+            try:
+                found = reader(where)
+            except Exception:
+                log.warn("Reading seed from %s failed!", where)
+                util.logexc(log)
+                continue
+            if not found:
+                continue
+            return (where, found[0], found[1])
+
+        log.debug("No local seed found in %s", [w for (_r, w) in candidates])
+        return None
+
+    def get_data(self):
+        found = self._find_seed()
+        if not found:
+            return False
+        (self.seed, self.metadata, self.userdata_raw) = found
+        log.info("Using local seed from: %s", self.seed)
+        log.debug("Received raw userdata: %s", self.userdata_raw)
+        log.debug("Received metadata: %s", self.metadata)
+        return True
+
+    def get_current_instance_id(self, timeout=None):
+        # (the seed is local, so looking for it again is cheap)
+        found = self._find_seed()
+        if not found:
+            return None
+        return found[1].get('instance-id', "iid-datasource")
+
+
+# the data sources (and what each depends on) of this module
+datasources = [
+    (DataSourceSeed, (data_source.DEP_FILESYSTEM,)),
+]
+
+
+# return a list of data sources that match this set of dependencies
+def get_datasource_list(depends):
+    return data_source.list_from_depends(depends, datasources)
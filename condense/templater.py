@@ -0,0 +1,226 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Renders templates. Those that only substitute $name (or ${name}) with
+values from the search list, optionally with ## comments, are rendered
+here without Cheetah (which is only imported for templates that need it).
+
+Cheetah templates are compiled only once. Template files are compiled into
+python modules kept in settings.template_cache_dir (named by a hash of what
+they contain), so that later runs only import them, and the compiled
+templates (of files & strings) are kept in memory.
+"""
+
+import errno
+import hashlib
+import imp
+import os
+import re
+import sys
+import tempfile
+
+import condense.log as logging
+import condense.settings as settings
+
+log = logging.getLogger()
+
+# digest => compiled template class
+_compiled = {}
+
+# sha1 of a template => its parts (or None when it needs Cheetah)
+_parsed = {}
+
+# What the simple templates can have in them besides text, anything else
+# starting with one of #, $ or \ is left for Cheetah
+_TOKEN_RE = re.compile(r"##[^\r\n]*(\r?\n)?|#[ \t]*\r?\n|\$\{([A-Za-z_]\w*)\}|"
+                       r"\$([A-Za-z_]\w*)|[#$\\]")
+
+
+def _sha1(text):
+    # unicode (like templates out of yaml) is hashed as utf-8, but kept
+    # apart from the same bytes since what it is parsed into is unicode too
+    if isinstance(text, unicode):
+        return "%s_u" % (hashlib.sha1(text.encode("utf-8")).hexdigest())
+    return hashlib.sha1(text).hexdigest()
+
+
+def _digest(source):
+    from Cheetah.Version import Version
+    return _sha1("%s\0%s\0" % (Version, sys.version_info[0:2]) + source)
+
+
+def _class_name(digest):
+    return "tmpl_%s" % (digest)
+
+
+def _generate(source, digest):
+    # the code of a python module defining the template (as a class)
+    from Cheetah.Template import Template
+    return Template.compile(source=source, returnAClass=False,
+                            moduleName=_class_name(digest),
+                            className=_class_name(digest))
+
+
+def _write_module(fn, code):
+    (fd, tmp_fn) = tempfile.mkstemp(prefix=os.path.basename(fn),
+                                    dir=os.path.dirname(fn))
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(code)
+        os.rename(tmp_fn, fn)
+    except:
+        os.unlink(tmp_fn)
+        raise
+
+
+def _load_module(source, digest):
+    name = _class_name(digest)
+    fn = os.path.join(settings.template_cache_dir, "%s.py" % (name))
+    if not os.path.isfile(fn):
+        code = _generate(source, digest)
+        try:
+            os.makedirs(settings.template_cache_dir, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        _write_module(fn, code)
+        log.debug("Compiled template %s into %s", name, fn)
+    # (python keeps its byte code beside it)
+    return getattr(imp.load_source(name, fn), name)
+
+
+def parse(source):
+    """
+    Split a simple template into its text & (name,) placeholders, returning
+    None if it needs Cheetah.
+    """
+    parts = []
+    pos = 0
+    for m in _TOKEN_RE.finditer(source):
+        text = source[pos:m.start()]
+        pos = m.end()
+        tok = m.group(0)
+        if tok.startswith("##") or tok.endswith("\n"):
+            # like Cheetah, a line with nothing but a comment (or a # ending
+            # it, which joins it with the next line) is dropped
+            line_start = source.rfind("\n", 0, m.start()) + 1
+            before = source[line_start:m.start()]
+            if m.start() - len(text) <= line_start and not before.strip():
+                text = text[0:len(text) - len(before)]
+            elif tok.startswith("##"):
+                text += m.group(1) or ""
+            parts.append(text)
+        elif tok == "#":
+            # a lone # is text, anything else is (or might be) a directive
+            if pos < len(source) and source[pos] not in " \t\r\n":
+                return None
+            parts.append(text + tok)
+        elif tok in ("$", "\\"):
+            return None
+        else:
+            name = m.group(2) or m.group(3)
+            if m.group(3):
+                # dotted names & calls are left for Cheetah
+                following = source[pos:pos + 2]
+                if following[0:1] in ("(", "[") or re.match(r"\.\w",
+                                                            following):
+                    return None
+            parts.append(text)
+            parts.append((name,))
+    parts.append(source[pos:])
+    return parts
+
+
+def _render_simple(source, search_list):
+    # None if the template (or its values) need Cheetah
+    digest = _sha1(source)
+    if digest not in _parsed:
+        _parsed[digest] = parse(source)
+    parts = _parsed[digest]
+    if parts is None:
+        return None
+    rendered = []
+    for part in parts:
+        if isinstance(part, tuple):
+            if part[0] not in search_list or callable(search_list[part[0]]):
+                # let Cheetah look it up (or call it, or complain about it)
+                return None
+            value = search_list[part[0]]
+            if value is None:
+                value = ''
+            elif not isinstance(value, basestring):
+                value = str(value)
+            part = value
+        rendered.append(part)
+    return "".join(rendered)
+
+
+def compile_file(path):
+    """
+    Returns the template class of a template file, compiling it (or
+    importing what it was compiled into before) the first time.
+    """
+    with open(path, "rb") as fh:
+        source = fh.read()
+    return _compile_source(source, path)
+
+
+def _compile_source(source, path):
+    digest = _digest(source)
+    cls = _compiled.get(digest)
+    if cls is None:
+        try:
+            cls = _load_module(source, digest)
+        except Exception:
+            log.debug("Failed using the compiled template of %s", path,
+                      exc_info=True)
+            from Cheetah.Template import Template
+            cls = Template.compile(source=source)
+        _compiled[digest] = cls
+    return cls
+
+
+def compile_string(source):
+    """
+    Returns the template class of a template string, compiled the first
+    time it is asked for.
+    """
+    digest = _digest(source)
+    cls = _compiled.get(digest)
+    if cls is None:
+        from Cheetah.Template import Template
+        cls = Template.compile(source=source)
+        _compiled[digest] = cls
+    return cls
+
+
+def render_file(path, search_list):
+    with open(path, "rb") as fh:
+        source = fh.read()
+    rendered = _render_simple(source, search_list)
+    if rendered is None:
+        cls = _compile_source(source, path)
+        rendered = cls(searchList=[search_list]).respond()
+    return rendered
+
+
+def render_string(source, search_list):
+    rendered = _render_simple(source, search_list)
+    if rendered is None:
+        cls = compile_string(source)
+        rendered = cls(searchList=[search_list]).respond()
+    return rendered
@@ -18,10 +18,6 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import email
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-
 STARTS_WITH_MAPPINGS = {
     '#cloud-config': 'text/cloud-config',
 }
@@ -76,6 +72,7 @@ def _type_from_startswith(payload, default=None):
 
 
 def _process(msg, appendmsg=None):
+    from email.mime.multipart import MIMEMultipart
     if appendmsg == None:
         appendmsg = MIMEMultipart()
 
@@ -104,6 +101,8 @@ def _process(msg, appendmsg=None):
 
 
 def _message_from_string(data, headers=None):
+    import email
+    from email.mime.base import MIMEBase
     if headers is None:
         headers = {}
     if "mime-version:" in data[0:4096].lower():
@@ -123,6 +122,7 @@ def _message_from_string(data, headers=None):
 
 
 def preprocess_userdata(data):
+    from email.mime.multipart import MIMEMultipart
     newmsg = MIMEMultipart()
     _process(_message_from_string(_decomp_str(data)), newmsg)
     return newmsg.as_string()
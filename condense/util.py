@@ -23,22 +23,27 @@ import os
 import platform
 import pprint
 import re
-import socket
 import subprocess
 import sys
 import traceback
 import urllib
-import urllib2
 import urlparse
-import yaml
 
+import condense.cfg_cache as cfg_cache
+import condense.exceptions as excp
+import condense.http_client as http_client
 import condense.log as logging
+import condense.process as process
+import condense.resolver as resolver
 import condense.settings as settings
-
-from Cheetah.Template import Template
+import condense.templater as templater
 
 log = logging.getLogger()
 
+# The yaml loader to parse configs with, picked (and yaml imported) when the
+# first config is parsed (see get_yaml_loader)
+YamlLoader = None
+
 DEB_PLATFORM = 'debian'
 RH_PLATFORM = 'redhat'
 PLATFORM_LOOKUPS = {
@@ -49,16 +54,34 @@ PLATFORM_LOOKUPS = {
 TMP_TPL = '/etc/cloud/templates/%s.tmpl'
 
 
+def get_yaml_loader():
+    global YamlLoader
+    if YamlLoader is None:
+        # the libyaml (C) based loader is much faster, use it when it is around
+        try:
+            from yaml import CLoader as loader
+        except ImportError:
+            from yaml import Loader as loader
+        YamlLoader = loader
+    return YamlLoader
+
+
 def read_conf(fname):
     try:
         with open(fname, "r") as stream:
+            st = os.fstat(stream.fileno())
+            (found, conf) = cfg_cache.load_parsed(fname, st)
+            if found:
+                return conf
             data = stream.read()
             data = data.strip()
             if not data:
                 conf = {}
             else:
-                conf = yaml.load(data)
+                import yaml
+                conf = yaml.load(data, Loader=get_yaml_loader())
             stream.close()
+        cfg_cache.save_parsed(fname, st, conf)
         return conf
     except IOError as e:
         if e.errno == errno.ENOENT:
@@ -66,22 +89,17 @@ def read_conf(fname):
         raise
 
 
-def get_base_cfg(cfgfile, cfg_builtin=None, parsed_cfgs=None):
+def get_base_cfg(cfgfile, cfg_builtin=None, parsed_cfgs=None, inputs=None):
     kerncfg = {}
     syscfg = {}
     if parsed_cfgs and cfgfile in parsed_cfgs:
         return(parsed_cfgs[cfgfile])
 
-    syscfg = read_conf_with_confd(cfgfile)
-
-    # kernel parameters override system config
-    combined = mergedict(kerncfg, syscfg)
+    syscfg = read_conf_with_confd(cfgfile, inputs)
 
-    if cfg_builtin:
-        builtin = dict(cfg_builtin)
-        fin = mergedict(combined, builtin)
-    else:
-        fin = combined
+    # kernel parameters override system config, which overrides the
+    # builtin config
+    fin = merge_dicts(kerncfg, syscfg, cfg_builtin or {})
 
     if parsed_cfgs != None:
         parsed_cfgs[cfgfile] = fin
@@ -140,16 +158,80 @@ def get_cfg_by_path(yobj, keyp, default=None):
 
 def mergedict(src, cand):
     """
-    Merge values from C{cand} into C{src}. If C{src} has a key C{cand} will
-    not override. Nested dictionaries are merged recursively.
+    Merge values from C{cand} into (a copy of) C{src}. If C{src} has a key
+    C{cand} will not override. Nested dictionaries are merged recursively.
     """
-    if isinstance(src, dict) and isinstance(cand, dict):
-        for k, v in cand.iteritems():
-            if k not in src:
-                src[k] = v
-            else:
-                src[k] = mergedict(src[k], v)
-    return src
+    return merge_dicts(src, cand)
+
+
+def _merge_frame(dicts):
+    # merge the keys the later dictionaries add into a copy of the first
+    # one, returning that copy, whether anything was added and the
+    # (key, dictionaries) that still need to be merged for keys whose
+    # values are dictionaries in more than one of them
+    first = dicts[0]
+    merged = dict(first)
+    added = False
+    nested = {}
+    for cand in dicts[1:]:
+        for (key, value) in cand.iteritems():
+            if key not in merged:
+                merged[key] = value
+                added = True
+            elif isinstance(value, dict):
+                cur = merged[key]
+                if not isinstance(cur, dict):
+                    continue
+                if key in nested:
+                    nested[key].append(value)
+                else:
+                    nested[key] = [cur, value]
+    return [first, merged, added, nested.items(), 0]
+
+
+def merge_dicts(*sources):
+    """
+    Merge the given sources into a new mapping, earlier sources taking
+    precedence over later ones. A key gets its value from the first source
+    that has it, unless that value is a dictionary, in which case the
+    dictionaries the later sources have for it are merged into it (in the
+    same way). Values that are not dictionaries are never merged, and a
+    first source that is not a dictionary is returned as is.
+
+    None of the sources are modified. Values (and subtrees) that nothing
+    was merged into are shared with the sources instead of being copied,
+    so only the top level of the result should be modified.
+
+    This walks the sources iteratively, so deeply nested sources can not
+    exhaust the recursion limit.
+    """
+    if not sources:
+        return {}
+    if not isinstance(sources[0], dict):
+        return sources[0]
+    dicts = [s for s in sources if isinstance(s, dict)]
+    stack = [(_merge_frame(dicts), None)]
+    while True:
+        (frame, parent_key) = stack[-1]
+        (first, merged, added, nested, pos) = frame
+        if pos < len(nested):
+            frame[4] += 1
+            (key, sub_dicts) = nested[pos]
+            stack.append((_merge_frame(sub_dicts), key))
+            continue
+
+        # all of this frame is merged, hand the result to its parent
+        stack.pop()
+        if not stack:
+            return merged
+        if not added:
+            # nothing was merged into it (or below it), share it
+            merged = first
+        parent = stack[-1][0]
+        parent[1][parent_key] = merged
+        if (parent_key not in parent[0] or
+            merged is not parent[0][parent_key]):
+            parent[2] = True
 
 
 def determine_platform():
@@ -198,28 +280,30 @@ def write_file(filename, content, mode=0644, omode="wb"):
             os.chmod(filename, mode)
 
 
-def subp(args, input_=None, allowed_rcs=None, env=None):
+def subp(args, input_=None, allowed_rcs=None, env=None, timeout=None):
     if not allowed_rcs:
         allowed_rcs = [0]
     log.info("Running command: `%s` with allowed return codes (%s)",
             " ".join(args), ", ".join([str(rc) for rc in allowed_rcs]))
-    sp = subprocess.Popen(args, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE, stdin=subprocess.PIPE, env=env)
-    out, err = sp.communicate(input_)
-    if sp.returncode not in allowed_rcs:
-        raise subprocess.CalledProcessError(sp.returncode, args)
-    return (out, err)
+    result = process.run(args, input_=input_, env=env, timeout=timeout)
+    if result.timed_out:
+        raise excp.ProcessTimeoutException("`%s` did not finish in %s "
+                                           "seconds" % (" ".join(args),
+                                                        timeout), result)
+    if result.returncode not in allowed_rcs:
+        raise subprocess.CalledProcessError(result.returncode, args)
+    return (result.stdout, result.stderr)
 
 
 def render_to_file(template, outfile, searchList):
     fn = settings.template_tpl % template
-    t = Template(file=fn, searchList=[searchList])
+    contents = templater.render_file(fn, searchList)
     with open(outfile, 'w') as f:
-        f.write(t.respond())
+        f.write(contents)
 
 
 def render_string(template, searchList):
-    return Template(template, searchList=[searchList]).respond()
+    return templater.render_string(template, searchList)
 
 
 def logexc(logger, lvl=logging.DEBUG):
@@ -228,9 +312,11 @@ def logexc(logger, lvl=logging.DEBUG):
     logger.log(lvl, traceback.format_exc())
 
 
-def read_conf_d(confd):
+def read_conf_d(confd, inputs=None):
     # get reverse sorted list (later trumps newer)
     confs = sorted(os.listdir(confd), reverse=True)
+    if inputs is not None:
+        inputs.append(confd)
 
     # remove anything not ending in '.cfg'
     confs = [f for f in confs if f.endswith(".cfg")]
@@ -238,15 +324,20 @@ def read_conf_d(confd):
     # remove anything not a file
     confs = [f for f in confs if os.path.isfile("%s/%s" % (confd, f))]
 
-    cfg = {}
+    cfgs = [{}]
     for conf in confs:
-        cfg = mergedict(cfg, read_conf("%s/%s" % (confd, conf)))
+        if inputs is not None:
+            inputs.append("%s/%s" % (confd, conf))
+        cfgs.append(read_conf("%s/%s" % (confd, conf)))
 
-    return(cfg)
+    return(merge_dicts(*cfgs))
 
 
-def read_conf_with_confd(cfgfile):
+# if given, the files (and directories) read are appended to 'inputs'
+def read_conf_with_confd(cfgfile, inputs=None):
     cfg = read_conf(cfgfile)
+    if inputs is not None:
+        inputs.append(cfgfile)
     confd = False
     if "conf_d" in cfg:
         if cfg['conf_d'] is not None:
@@ -256,11 +347,14 @@ def read_conf_with_confd(cfgfile):
                                 "with non-string" % cfgfile)
     elif os.path.isdir("%s.d" % cfgfile):
         confd = "%s.d" % cfgfile
+    elif inputs is not None:
+        # creating it later on would change the config
+        inputs.append("%s.d" % cfgfile)
 
     if not confd:
         return cfg
 
-    confd_cfg = read_conf_d(confd)
+    confd_cfg = read_conf_d(confd, inputs)
     return mergedict(confd_cfg, cfg)
 
 
@@ -298,18 +392,11 @@ def chownbyname(fname, user=None, group=None):
 
 
 def readurl(url, data=None, timeout=None):
-    openargs = {}
-    if timeout != None:
-        openargs['timeout'] = timeout
-
-    if data is None:
-        req = urllib2.Request(url)
-    else:
+    encoded = None
+    if data is not None:
         encoded = urllib.urlencode(data)
-        req = urllib2.Request(url, encoded)
-
-    response = urllib2.urlopen(req, **openargs)
-    return response.read()
+    response = http_client.request(url, data=encoded, timeout=timeout)
+    return response.contents
 
 
 # shellify, takes a list of commands
@@ -393,18 +480,24 @@ def get_fqdn_from_hosts(hostname, filename="/etc/hosts"):
     return fqdn
 
 
-def is_resolvable(name):
+def is_resolvable(name, timeout=None):
     """ determine if a url is resolvable, return a boolean """
-    try:
-        socket.getaddrinfo(name, None)
-        return True
-    except socket.gaierror:
-        return False
+    return resolver.is_resolvable(name, timeout)
 
 
-def is_resolvable_url(url):
+def is_resolvable_url(url, timeout=None):
     """ determine if this url is resolvable (existing or ip) """
-    return is_resolvable(urlparse.urlparse(url).hostname)
+    return is_resolvable(urlparse.urlparse(url).hostname, timeout)
+
+
+def filter_resolvable_urls(urls, timeout=None):
+    """
+    return the urls that are resolvable, resolving all of their
+    hostnames concurrently (and waiting at most timeout seconds)
+    """
+    hosts = [urlparse.urlparse(url).hostname for url in urls]
+    resolved = resolver.resolve(hosts, timeout)
+    return [url for (url, host) in zip(urls, hosts) if resolved[host]]
 
 
 def close_stdin():
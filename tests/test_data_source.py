@@ -0,0 +1,47 @@
+import cPickle
+import unittest
+
+from condense import data_source
+
+
+class CachedFile(object):
+
+    def __init__(self, contents):
+        self.fn = "/cached"
+        self.contents = contents
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        return self.contents
+
+
+class TestCachedFiles(unittest.TestCase):
+
+    def test_lock_per_instance(self):
+        first = data_source.DataSource()
+        second = data_source.DataSource()
+        self.assertTrue(first._cached_files_lock is not
+                        second._cached_files_lock)
+
+    def test_pickled(self):
+        ds = data_source.DataSource()
+        ds.metadata = {'instance-id': 'i-1'}
+        restored = cPickle.loads(cPickle.dumps(ds))
+        self.assertEquals(restored.metadata, {'instance-id': 'i-1'})
+        self.assertTrue(restored._cached_files_lock is not
+                        ds._cached_files_lock)
+        # (still usable)
+        self.assertEquals(restored.get_userdata_raw(), None)
+
+    def test_read_once(self):
+        ds = data_source.DataSource()
+        cached = CachedFile("#cloud-config\n")
+        ds.cached_files = {'userdata_raw': cached}
+        self.assertEquals(ds.get_userdata_raw(), "#cloud-config\n")
+        self.assertEquals(ds.get_userdata_raw(), "#cloud-config\n")
+        self.assertEquals(cached.reads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
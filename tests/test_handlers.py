@@ -0,0 +1,257 @@
+import logging
+import threading
+import time
+import unittest
+
+from condense import exceptions as excp
+from condense import handlers
+from condense import util
+
+from condense.handlers import bootcmd
+from condense.handlers import locale
+
+log = logging.getLogger("test_handlers")
+log.addHandler(logging.NullHandler())
+
+
+class FakeConfig(object):
+    """
+    Runs fake handlers (name => (depends, resources)), recording when each
+    started & finished and how many ran at once.
+    """
+
+    def __init__(self, declared, workers=None, pause=0.05, failing=()):
+        self.cfg = {}
+        if workers is not None:
+            self.cfg['handler_workers'] = workers
+        self.declared = declared
+        self.pause = pause
+        self.failing = failing
+        self.events = []
+        self.running = set()
+        self.overlaps = []
+        self.lock = threading.Lock()
+
+    def get_handler_info(self, name):
+        (depends, resources) = self.declared[name]
+        return {
+            'module': 'fake.%s' % (name),
+            'frequency': 'always',
+            'depends': depends,
+            'resources': resources,
+        }
+
+    def handle(self, name, args, freq=None):
+        with self.lock:
+            self.events.append(('start', name))
+            if self.running:
+                self.overlaps.append((name, sorted(self.running)))
+            self.running.add(name)
+        time.sleep(self.pause)
+        with self.lock:
+            self.running.remove(name)
+            self.events.append(('end', name))
+        if name in self.failing:
+            raise RuntimeError("%s failed" % (name))
+
+    def started(self):
+        return [name for (what, name) in self.events if what == 'start']
+
+    def ended_before_start(self, first, then):
+        return (self.events.index(('end', first)) <
+                self.events.index(('start', then)))
+
+    def overlapped(self, name):
+        found = set()
+        for (started, running) in self.overlaps:
+            if started == name:
+                found.update(running)
+            elif name in running:
+                found.add(started)
+        return found
+
+
+def modules(*names):
+    return [[name] for name in names]
+
+
+class TestRunCcModules(unittest.TestCase):
+
+    def test_concurrent_by_default(self):
+        cc = FakeConfig({
+            'a': ([], ['x']),
+            'b': ([], ['y']),
+            'c': ([], None),
+        }, pause=0.3)
+        failed = handlers.run_cc_modules(cc, modules('a', 'b', 'c'), log)
+        self.assertEquals(failed, [])
+        self.assertEquals(cc.overlapped('a'), set(['b']))
+        # (and what did not declare its resources alone)
+        self.assertEquals(cc.overlapped('c'), set())
+
+    def test_serial(self):
+        cc = FakeConfig({
+            'a': ([], ['x']),
+            'b': ([], ['y']),
+            'c': ([], ['z']),
+        }, workers=1)
+        failed = handlers.run_cc_modules(cc, modules('a', 'b', 'c'), log)
+        self.assertEquals(failed, [])
+        self.assertEquals(cc.started(), ['a', 'b', 'c'])
+        self.assertEquals(cc.overlaps, [])
+
+    def test_serial_depends(self):
+        cc = FakeConfig({
+            'hosts': (['hostname'], ['/etc/hosts']),
+            'hostname': ([], ['/etc/hostname']),
+            'other': ([], None),
+        }, workers=1)
+        handlers.run_cc_modules(cc, modules('hosts', 'other', 'hostname'),
+                                log)
+        self.assertEquals(cc.started(), ['other', 'hostname', 'hosts'])
+
+    def test_depends(self):
+        cc = FakeConfig({
+            'hosts': (['hostname'], ['/etc/hosts']),
+            'hostname': ([], ['/etc/hostname']),
+            'tz': ([], ['/etc/timezone']),
+        }, workers=4)
+        handlers.run_cc_modules(cc, modules('hosts', 'tz', 'hostname'), log)
+        self.assertTrue(cc.ended_before_start('hostname', 'hosts'))
+        self.assertTrue('hostname' not in cc.overlapped('hosts'))
+
+    def test_depends_on_missing(self):
+        # depending on a handler that is not in the stage does not hold it
+        cc = FakeConfig({
+            'hosts': (['hostname'], ['/etc/hosts']),
+        }, workers=4)
+        self.assertEquals(handlers.run_cc_modules(cc, modules('hosts'), log),
+                          [])
+        self.assertEquals(cc.started(), ['hosts'])
+
+    def test_shared_resources(self):
+        cc = FakeConfig({
+            'a': ([], ['/etc/fstab']),
+            'b': ([], ['/etc/fstab', 'mounts']),
+            'c': ([], ['/etc/timezone']),
+        }, workers=4)
+        handlers.run_cc_modules(cc, modules('a', 'b', 'c'), log)
+        # one at a time, in the order listed
+        self.assertTrue(cc.ended_before_start('a', 'b'))
+        self.assertEquals(cc.overlapped('a') & set(['b']), set())
+
+    def test_disjoint_resources(self):
+        cc = FakeConfig({
+            'a': ([], ['x']),
+            'b': ([], ['y']),
+        }, workers=4, pause=0.3)
+        handlers.run_cc_modules(cc, modules('a', 'b'), log)
+        self.assertEquals(cc.overlapped('a'), set(['b']))
+
+    def test_undeclared_resources(self):
+        cc = FakeConfig({
+            'a': ([], ['x']),
+            'anything': ([], None),
+            'b': ([], ['y']),
+            'nothing': ([], []),
+        }, workers=4)
+        handlers.run_cc_modules(cc, modules('a', 'anything', 'b', 'nothing'),
+                                log)
+        self.assertEquals(cc.overlapped('anything'), set())
+        self.assertTrue(cc.ended_before_start('a', 'anything'))
+        self.assertTrue(cc.ended_before_start('anything', 'b'))
+        self.assertTrue(cc.ended_before_start('anything', 'nothing'))
+
+    def test_cycle(self):
+        cc = FakeConfig({
+            'a': (['b'], ['x']),
+            'b': (['a'], ['y']),
+        }, workers=4)
+        failed = handlers.run_cc_modules(cc, modules('a', 'b'), log)
+        self.assertEquals(failed, [])
+        # broken at the one listed first
+        self.assertTrue(cc.ended_before_start('a', 'b'))
+
+    def test_failures_in_listed_order(self):
+        cc = FakeConfig({
+            'a': ([], ['x']),
+            'b': ([], ['y']),
+            'c': (['b'], ['z']),
+        }, workers=4, failing=('a', 'c'))
+        failed = handlers.run_cc_modules(cc, modules('c', 'b', 'a'), log)
+        self.assertEquals(failed, ['c', 'a'])
+        # a failed handler still lets those that depend on it run
+        self.assertEquals(sorted(cc.started()), ['a', 'b', 'c'])
+
+
+class TestOrderCcModules(unittest.TestCase):
+
+    def test_listed_order(self):
+        (order, after) = handlers._order_cc_modules(['a', 'b', 'c'],
+                                                     [[], [], []], log)
+        self.assertEquals(order, [0, 1, 2])
+        self.assertEquals(after, [set(), set(), set()])
+
+    def test_normalized_names(self):
+        (order, after) = handlers._order_cc_modules(
+            ['update_etc_hosts', 'set-hostname'],
+            [['set_hostname'], []], log)
+        self.assertEquals(order, [1, 0])
+        self.assertEquals(after, [set([1]), set()])
+
+    def test_cycle(self):
+        (order, after) = handlers._order_cc_modules(['a', 'b', 'c'],
+                                                     [['c'], ['a'], ['b']],
+                                                     log)
+        self.assertEquals(order, [0, 1, 2])
+        self.assertEquals(after, [set(), set([0]), set([1])])
+
+
+class FakeCloud(object):
+
+    def get_instance_id(self):
+        return "i-1"
+
+
+class TestTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.subp = util.subp
+        self.ran = []
+
+        def subp(args, input_=None, allowed_rcs=None, env=None,
+                 timeout=None):
+            self.ran.append((args, timeout))
+            return ("", "")
+
+        util.subp = subp
+
+    def tearDown(self):
+        util.subp = self.subp
+
+    def test_bootcmd_default(self):
+        bootcmd.handle('bootcmd', {'bootcmd': ['true']}, FakeCloud(), log,
+                       [])
+        self.assertEquals(self.ran, [(['/bin/sh'],
+                                      bootcmd.DEF_BOOTCMD_TIMEOUT)])
+
+    def test_bootcmd_configured(self):
+        cfg = {'bootcmd': ['true'], 'bootcmd_timeout': '2.5'}
+        bootcmd.handle('bootcmd', cfg, FakeCloud(), log, [])
+        self.assertEquals(self.ran, [(['/bin/sh'], 2.5)])
+
+    def test_bootcmd_hung(self):
+        util.subp = self.subp
+        cfg = {'bootcmd': ['sleep 10'], 'bootcmd_timeout': 0.2}
+        started = time.time()
+        self.assertRaises(excp.ProcessTimeoutException, bootcmd.handle,
+                          'bootcmd', cfg, FakeCloud(), log, [])
+        self.assertTrue(time.time() - started < 5)
+
+    def test_locale_hung(self):
+        self.assertRaises(excp.ProcessTimeoutException, locale._run,
+                          ['sleep', '10'], 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import time
+import unittest
+
+from condense import exceptions as excp
+from condense import process
+from condense import util
+
+
+class TestRun(unittest.TestCase):
+
+    def test_output(self):
+        result = process.run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEquals(result.returncode, 3)
+        self.assertEquals(result.stdout, "out\n")
+        self.assertEquals(result.stderr, "err\n")
+        self.assertFalse(result.timed_out)
+        self.assertTrue(result.rusage is not None)
+
+    def test_input(self):
+        # more than a pipe holds, so that it has to be fed as it is read
+        data = "condense\n" * 100000
+        result = process.run(['cat'], input_=data)
+        self.assertEquals(result.returncode, 0)
+        self.assertEquals(result.stdout, data)
+
+    def test_input_not_read(self):
+        result = process.run(['true'], input_="x" * 1000000)
+        self.assertEquals(result.returncode, 0)
+
+    def test_truncated(self):
+        result = process.run(['sh', '-c', 'yes | head -c 10000'],
+                             capture_limit=100)
+        self.assertEquals(result.stdout, "y\n" * 50)
+        self.assertTrue(result.truncated['stdout'])
+        self.assertFalse(result.truncated['stderr'])
+
+    def test_timeout(self):
+        started = time.time()
+        result = process.run(['sleep', '10'], timeout=0.5)
+        self.assertTrue(time.time() - started < 5)
+        self.assertTrue(result.timed_out)
+        self.assertEquals(result.returncode, -15)
+
+    def test_timeout_killed(self):
+        started = time.time()
+        result = process.run(['sh', '-c', 'trap "" TERM; sleep 10 & wait'],
+                             timeout=0.2, kill_grace=0.5)
+        self.assertTrue(time.time() - started < 5)
+        self.assertTrue(result.timed_out)
+        self.assertEquals(result.returncode, -9)
+
+    def test_background_keeps_output_open(self):
+        started = time.time()
+        result = process.run(['sh', '-c', 'setsid sleep 4 & echo started'],
+                             timeout=1)
+        self.assertTrue(time.time() - started < 2)
+        self.assertFalse(result.timed_out)
+        self.assertEquals(result.returncode, 0)
+        self.assertEquals(result.stdout, "started\n")
+
+    def test_subp_exited_before_timeout(self):
+        (out, _err) = util.subp(['sh', '-c', 'setsid sleep 4 & echo started'],
+                                timeout=1)
+        self.assertEquals(out, "started\n")
+
+    def test_subp_timeout(self):
+        self.assertRaises(excp.ProcessTimeoutException, util.subp,
+                          ['sleep', '10'], timeout=0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import shutil
+import socket
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from condense import resident
+
+# serves stages (answering with the length of their name) with the socket
+# it is given as its stdin, like the condenser started by start does
+SERVE = """
+import os
+from condense import resident
+server = resident.Server.from_fd(0, %r)
+fd = os.open(os.devnull, os.O_RDONLY)
+os.dup2(fd, 0)
+server.serve(lambda request: len(request['action']), last_action='final')
+"""
+
+
+class TestResident(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmp_dir, "resident.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_spawned(self):
+        server = resident.Server(self.fn)
+        self.assertTrue(server.bind())
+        resident.spawn(server, [sys.executable, '-c', SERVE % (self.fn)])
+        server.close(unlink=False)
+        out = StringIO.StringIO()
+        self.assertEquals(resident.request(self.fn, 'config', out), 6)
+        self.assertEquals(resident.request(self.fn, 'final', out), 5)
+        # (it stops after the last stage)
+        self.assertEquals(resident.request(self.fn, 'final', out), None)
+
+    def test_forked(self):
+        # it keeps what was loaded before it was forked
+        loaded = {'config': 42}
+        server = resident.Server(self.fn)
+        self.assertTrue(server.bind())
+        self.assertEquals(resident.quiesce(), [])
+        pid = resident.detach()
+        if not pid:
+            rc = 1
+            try:
+                rc = server.serve(lambda request: loaded[request['action']],
+                                  last_action='config')
+            finally:
+                os._exit(rc)
+        server.close(unlink=False)
+        loaded['config'] = 0
+        out = StringIO.StringIO()
+        self.assertEquals(resident.request(self.fn, 'config', out), 42)
+        (_pid, status) = os.waitpid(pid, 0)
+        self.assertEquals(os.WEXITSTATUS(status), 0)
+
+    def test_quiesce(self):
+        done = threading.Event()
+        t = threading.Thread(target=done.wait, args=(10,), name="hung")
+        t.daemon = True
+        t.start()
+        try:
+            self.assertEquals(resident.quiesce(0.2), [t])
+        finally:
+            done.set()
+        self.assertEquals(resident.quiesce(5), [])
+
+    def test_none_listening(self):
+        out = StringIO.StringIO()
+        self.assertEquals(resident.request(self.fn, 'config', out), None)
+
+    def test_not_accepted(self):
+        # bound, but nothing takes on what connects
+        server = resident.Server(self.fn)
+        self.assertTrue(server.bind())
+        try:
+            out = StringIO.StringIO()
+            started = time.time()
+            self.assertEquals(resident.request(self.fn, 'config', out,
+                                               accept_timeout=0.5), None)
+            self.assertTrue(time.time() - started < 5)
+        finally:
+            server.close()
+
+    def test_hung(self):
+        server = resident.Server(self.fn)
+        self.assertTrue(server.bind())
+        done = threading.Event()
+
+        def hang(request):
+            done.wait(10)
+            return 0
+
+        t = threading.Thread(target=server.serve, args=(hang,),
+                             kwargs={'last_action': 'config'})
+        t.daemon = True
+        t.start()
+        try:
+            out = StringIO.StringIO()
+            # it was started, so it is not run by the client too
+            self.assertEquals(resident.request(self.fn, 'config', out,
+                                               reply_timeout=0.5), 1)
+        finally:
+            done.set()
+            t.join()
+            server.close()
+
+    def test_client_gone(self):
+        # a stage the client gave up on is not run
+        server = resident.Server(self.fn)
+        self.assertTrue(server.bind())
+        ran = []
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(self.fn)
+            client.sendall('{"action": "config"}\n')
+            client.close()
+            server.serve(lambda request: ran.append(request), idle_timeout=0.5)
+        finally:
+            server.close()
+        self.assertEquals(ran, [])
+
+    def test_gave_up_after_accepted(self):
+        # the client gave up (to run it itself) once the stage was accepted,
+        # but before starting it
+        server = resident.Server(self.fn)
+        self.assertTrue(server.bind())
+        ran = []
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(self.fn)
+            client.sendall('{"action": "config"}\n')
+            t = threading.Thread(target=server.serve,
+                                 args=(lambda request: ran.append(request),),
+                                 kwargs={'idle_timeout': 0.5})
+            t.start()
+            fh = client.makefile("rb")
+            self.assertEquals(fh.readline(), '{"accepted": "config"}\n')
+            fh.close()
+            client.close()
+            t.join()
+        finally:
+            server.close()
+        self.assertEquals(ran, [])
+
+    def test_started(self):
+        server = resident.Server(self.fn)
+        self.assertTrue(server.bind())
+        ran = []
+        t = threading.Thread(target=server.serve,
+                             args=(lambda request: ran.append(request) or 3,),
+                             kwargs={'last_action': 'config'})
+        t.start()
+        try:
+            out = StringIO.StringIO()
+            self.assertEquals(resident.request(self.fn, 'config', out), 3)
+        finally:
+            t.join()
+            server.close()
+        self.assertEquals(ran, [{'action': 'config'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from condense.sources import seed
+
+
+class TestSeed(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.seed_dir = os.path.join(self.tmp_dir, "seed")
+        os.makedirs(self.seed_dir)
+        self.write_seed("instance-id: i-1\n")
+        self.cfg = {
+            'datasource': {
+                'Seed': {
+                    'seed_dirs': [self.seed_dir],
+                    'config_drive_labels': [],
+                },
+            },
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_seed(self, metadata):
+        with open(os.path.join(self.seed_dir, "meta-data"), "wb") as fh:
+            fh.write(metadata)
+
+    def test_get_data(self):
+        ds = seed.DataSourceSeed(self.cfg)
+        self.assertTrue(ds.get_data())
+        self.assertEquals(ds.seed, self.seed_dir)
+        self.assertEquals(ds.get_instance_id(), "i-1")
+        self.assertEquals(ds.get_userdata_raw(), "")
+
+    def test_current_instance_id(self):
+        ds = seed.DataSourceSeed(self.cfg)
+        self.assertTrue(ds.get_data())
+        self.assertEquals(ds.get_current_instance_id(), "i-1")
+        # (an image of it, given a seed of its own)
+        self.write_seed("instance-id: i-2\n")
+        self.assertEquals(ds.get_current_instance_id(), "i-2")
+        self.assertEquals(ds.get_instance_id(), "i-1")
+
+    def test_current_instance_id_unset(self):
+        self.write_seed("local-hostname: h\n")
+        ds = seed.DataSourceSeed(self.cfg)
+        self.assertTrue(ds.get_data())
+        self.assertEquals(ds.get_current_instance_id(),
+                          ds.get_instance_id())
+
+    def test_seed_gone(self):
+        ds = seed.DataSourceSeed(self.cfg)
+        self.assertTrue(ds.get_data())
+        shutil.rmtree(self.seed_dir)
+        self.assertEquals(ds.get_current_instance_id(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
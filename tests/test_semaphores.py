@@ -0,0 +1,185 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import condense
+
+from condense import semaphores
+
+
+class TestSemaphoreDB(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmp_dir, "sem", "semaphores.db")
+        self.dbs = []
+
+    def tearDown(self):
+        for db in self.dbs:
+            db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def db(self, legacy=None):
+        db = semaphores.SemaphoreDB(self.fn, legacy)
+        self.dbs.append(db)
+        return db
+
+    def entries(self):
+        with open(self.fn, "rb") as fh:
+            return fh.read().splitlines()
+
+    def test_acquire(self):
+        db = self.db()
+        self.assertFalse(db.has('a'))
+        self.assertTrue(db.acquire('a'))
+        self.assertFalse(db.acquire('a'))
+        self.assertTrue(db.has('a'))
+        db.clear('a')
+        self.assertFalse(db.has('a'))
+        self.assertTrue(db.acquire('a'))
+
+    def test_written_when_acquired(self):
+        # (not only once flushed)
+        self.db().acquire('a')
+        self.assertEquals(len(self.entries()), 2)
+        self.assertTrue(self.db().has('a'))
+
+    def test_shared(self):
+        # each has the journal open (and locked) on its own, like processes
+        first = self.db()
+        second = self.db()
+        self.assertTrue(first.acquire('a'))
+        self.assertFalse(second.acquire('a'))
+        second.clear('a')
+        self.assertFalse(first.has('a'))
+        self.assertTrue(first.acquire('a'))
+
+    def test_processes(self):
+        pids = []
+        for _i in range(0, 8):
+            pid = os.fork()
+            if pid == 0:
+                rc = 1
+                try:
+                    db = semaphores.SemaphoreDB(self.fn)
+                    if db.acquire('once'):
+                        rc = 0
+                finally:
+                    os._exit(rc)
+            pids.append(pid)
+        acquired = 0
+        for pid in pids:
+            (_pid, status) = os.waitpid(pid, 0)
+            if os.WEXITSTATUS(status) == 0:
+                acquired += 1
+        self.assertEquals(acquired, 1)
+        self.assertTrue(self.db().has('once'))
+
+    def test_flush_compacts(self):
+        db = self.db()
+        for i in range(0, 5):
+            db.acquire('a')
+            db.clear('a')
+        db.acquire('b')
+        other = self.db()
+        self.assertTrue(other.has('b'))
+        self.assertTrue(db.flush())
+        self.assertEquals(len(self.entries()), 2)
+        # both pick up the compacted journal
+        self.assertTrue(other.has('b'))
+        self.assertFalse(other.has('a'))
+        self.assertTrue(db.acquire('a'))
+        self.assertFalse(other.acquire('a'))
+        self.assertFalse(db.flush())
+
+    def test_torn_entry(self):
+        self.db().acquire('a')
+        with open(self.fn, "ab") as fh:
+            fh.write('["acquire", "b", 1')
+        db = self.db()
+        self.assertTrue(db.has('a'))
+        self.assertFalse(db.has('b'))
+        self.assertTrue(db.acquire('c'))
+        self.assertTrue(self.db().has('c'))
+
+    def test_legacy(self):
+        calls = []
+
+        def legacy():
+            calls.append(True)
+            return {'old.once': (1.0, 10), 'i-1/old': (None, None)}
+
+        db = self.db(legacy)
+        self.assertTrue(db.has('old.once'))
+        self.assertTrue(db.has('i-1/old'))
+        self.assertFalse(db.acquire('old.once'))
+        # only imported into a new journal
+        self.assertTrue(self.db(legacy).has('i-1/old'))
+        self.assertEquals(len(calls), 1)
+
+    def test_legacy_fails(self):
+
+        def legacy():
+            raise IOError("broken")
+
+        db = self.db(legacy)
+        self.assertTrue(db.acquire('a'))
+
+
+class FakeInit(object):
+
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+        self.datasource = object()
+
+    def get_ipath(self, name):
+        return os.path.join(self.tmp_dir, "instance", name)
+
+    def get_instance_id(self):
+        return "i-1"
+
+
+class TestLegacyFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.get_cpath = condense.get_cpath
+        condense.get_cpath = lambda name: os.path.join(self.tmp_dir, name)
+
+    def tearDown(self):
+        condense.get_cpath = self.get_cpath
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path, contents):
+        path = os.path.join(self.tmp_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as fh:
+            fh.write(contents)
+
+    def test_import(self):
+        init = FakeInit(self.tmp_dir)
+        self.write("sem/bootcmd.once", "1337.5\n42\n")
+        self.write("instance/sem/set_hostname", "1338.0\n43\n")
+        self.write("instance/sem/garbled", "")
+        found = condense.Init._sem_legacy.im_func(init)
+        self.assertEquals(found, {
+            'bootcmd.once': (1337.5, 42),
+            'i-1/set_hostname': (1338.0, 43),
+            'i-1/garbled': (None, None),
+        })
+        db = semaphores.SemaphoreDB(os.path.join(self.tmp_dir, "sem.db"),
+                                    lambda: found)
+        try:
+            self.assertTrue(db.has('i-1/set_hostname'))
+        finally:
+            db.close()
+
+    def test_none(self):
+        init = FakeInit(self.tmp_dir)
+        self.assertEquals(condense.Init._sem_legacy.im_func(init), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from condense import settings
+from condense import templater
+
+# needs Cheetah (an #if), with text that is not ascii
+CHEETAH_TMPL = u"caf\xe9 #if $x\n$x\n#end if\n"
+
+
+class TestCompile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = settings.template_cache_dir
+        settings.template_cache_dir = os.path.join(self.tmp_dir, "templates")
+        templater._compiled.clear()
+        templater._parsed.clear()
+
+    def tearDown(self):
+        settings.template_cache_dir = self.cache_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def test_compile_string(self):
+        cls = templater.compile_string(CHEETAH_TMPL)
+        self.assertTrue(templater.compile_string(CHEETAH_TMPL) is cls)
+        self.assertEquals(cls(searchList=[{'x': u'cr\xe8me'}]).respond(),
+                          u"caf\xe9 \ncr\xe8me\n")
+
+    def test_compile_source(self):
+        cls = templater._compile_source(CHEETAH_TMPL, "unicode.tmpl")
+        self.assertEquals(cls(searchList=[{'x': u'cr\xe8me'}]).respond(),
+                          u"caf\xe9 \ncr\xe8me\n")
+        # it was compiled into a module, which is what is used later
+        self.assertEquals(len(os.listdir(settings.template_cache_dir)), 1)
+        templater._compiled.clear()
+        again = templater._compile_source(CHEETAH_TMPL, "unicode.tmpl")
+        self.assertEquals(again(searchList=[{'x': u'\xe8'}]).respond(),
+                          u"caf\xe9 \n\xe8\n")
+
+    def test_digest(self):
+        # the same text as unicode & as utf-8 are compiled apart
+        self.assertNotEquals(templater._digest(CHEETAH_TMPL),
+                             templater._digest(CHEETAH_TMPL.encode("utf-8")))
+
+
+class TestRender(unittest.TestCase):
+
+    def test_unicode(self):
+        rendered = templater.render_string(u"caf\xe9 $x ${y}\n",
+                                           {'x': u'cr\xe8me', 'y': 2})
+        self.assertEquals(rendered, u"caf\xe9 cr\xe8me 2\n")
+        self.assertTrue(isinstance(rendered, unicode))
+
+    def test_unicode_and_bytes(self):
+        # parsed apart, so the bytes come out as bytes
+        self.assertEquals(templater.render_string(u"$x\xe9", {'x': 'a'}),
+                          u"a\xe9")
+        rendered = templater.render_string("$x\xc3\xa9", {'x': 'a'})
+        self.assertEquals(rendered, "a\xc3\xa9")
+        self.assertTrue(isinstance(rendered, str))
+
+    def test_unicode_cheetah(self):
+        self.assertEquals(templater.render_string(CHEETAH_TMPL, {'x': 1}),
+                          u"caf\xe9 \n1\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
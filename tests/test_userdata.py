@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import condense
+
+from condense import user_data as ud
+
+
+class FakeInit(condense.Init):
+    # an Init (without a config or datasource) keeping its instance files
+    # in a directory of its own
+
+    def __init__(self, tmp_dir, userdata_raw):
+        self.tmp_dir = tmp_dir
+        self.userdata_raw = userdata_raw
+        self.cfg = {}
+        self.builtin_handlers = [
+            ['text/cloud-config', self.handle_cloud_config,
+             condense.per_always],
+        ]
+        self.cloud_config_str = ''
+
+    def get_ipath(self, name=None):
+        return os.path.join(self.tmp_dir, name)
+
+    def get_userdata_raw(self):
+        return self.userdata_raw
+
+    def get_userdata(self):
+        return ud.preprocess_userdata(self.userdata_raw)
+
+
+class TestConsumeUserdata(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def cloud_config(self):
+        with open(os.path.join(self.tmp_dir, 'cloud_config'), "rb") as fh:
+            return fh.read()
+
+    def test_unchanged(self):
+        cloud = FakeInit(self.tmp_dir, "#cloud-config\nhostname: one\n")
+        self.assertTrue(cloud.consume_userdata())
+        self.assertTrue("hostname: one" in self.cloud_config())
+        self.assertFalse(cloud.consume_userdata())
+        self.assertFalse(FakeInit(self.tmp_dir,
+                                  cloud.userdata_raw).consume_userdata())
+
+    def test_changed(self):
+        cloud = FakeInit(self.tmp_dir, "#cloud-config\nhostname: one\n")
+        self.assertTrue(cloud.consume_userdata())
+        cloud = FakeInit(self.tmp_dir, "#cloud-config\nhostname: two\n")
+        self.assertTrue(cloud.consume_userdata())
+        self.assertTrue("hostname: two" in self.cloud_config())
+        self.assertFalse("hostname: one" in self.cloud_config())
+        self.assertFalse(cloud.consume_userdata())
+
+    def test_output_gone(self):
+        cloud = FakeInit(self.tmp_dir, "#cloud-config\nhostname: one\n")
+        self.assertTrue(cloud.consume_userdata())
+        os.unlink(os.path.join(self.tmp_dir, 'cloud_config'))
+        self.assertTrue(cloud.consume_userdata())
+        self.assertTrue("hostname: one" in self.cloud_config())
+
+    def test_unfinished(self):
+        # consuming it did not get as far as remembering what it consumed
+        cloud = FakeInit(self.tmp_dir, "#cloud-config\nhostname: one\n")
+        self.assertTrue(cloud.consume_userdata())
+        os.unlink(os.path.join(self.tmp_dir, 'userdata_hash'))
+        self.assertTrue(cloud.consume_userdata())
+
+    def test_forced(self):
+        cloud = FakeInit(self.tmp_dir, "#cloud-config\nhostname: one\n")
+        self.assertTrue(cloud.consume_userdata())
+        self.assertTrue(cloud.consume_userdata(force=True))
+
+
+if __name__ == '__main__':
+    unittest.main()